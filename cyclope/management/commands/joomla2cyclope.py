@@ -9,17 +9,611 @@ from cyclope.core.collections.models import Collection, Category, Categorization
 from django.contrib.contenttypes.models import ContentType
 from cyclope.apps.medialibrary.models import Picture
 from django.contrib.contenttypes.models import ContentType
-from django.db import IntegrityError, transaction, connection
+from django.db import transaction, connection, connections, reset_queries
+from django.db.backends.signals import connection_created
+from django.db.models import Max, ForeignKey
+from django.conf import settings
+from filebrowser import settings as filebrowser_settings
 import operator
+import gzip
 from autoslug.settings import slugify
 from datetime import datetime
+from decimal import Decimal
+from itertools import islice, groupby
+import heapq
 from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
 from lxml import html, etree
 from lxml.cssselect import CSSSelector
 import json
-from io import BytesIO
-import time
+from io import BytesIO, BufferedReader
+from StringIO import StringIO
+from HTMLParser import HTMLParser
+import urlparse
 from collections import Counter
+import time
+import os
+import sys
+import urllib
+import threading
+import traceback
+from Queue import Queue
+from multiprocessing import Pool, Process
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
+import resource
+import hashlib
+import shutil
+import fcntl
+import tempfile
+import mmap
+import zlib
+import cPickle as pickle
+try:
+    # Pillow or PIL, only needed for thumbnails when ingesting image files
+    from PIL import Image, ImageOps
+except ImportError:
+    try:
+        import Image, ImageOps
+    except ImportError:
+        Image = None
+
+# compiled once, it's used for every article
+img_selector = CSSSelector('img')
+link_selector = CSSSelector('a[href]')
+# links to Joomla's own pages
+joomla_link_re = re.compile(r'[?&](option=com_content|Itemid=)', re.I)
+href_re = re.compile(r'''(href\s*=\s*)(["'])(.*?)\2''', re.I | re.S)
+html_parser = HTMLParser()
+
+def parse_html(full_content):
+    """returns src and alt pairs for each <img> HTML tag in content, and the hrefs of links to Joomla pages,
+       or None if it can't be parsed. it is a module function so that it can be sent to worker processes."""
+    try: # FIXME x-treme hack! html.fromstring having ID collisions, collect_ids is not an option...
+        context = etree.iterparse(BytesIO(full_content.encode('utf-8')), huge_tree=True, html=True)
+        for action, elem in context: pass # just read it
+        tree = context.root
+        images = [(img.get('src'), img.get('alt')) for img in img_selector(tree)]
+        links = [link.get('href') for link in link_selector(tree) if joomla_link_re.search(link.get('href'))]
+        return images, links
+    except:
+        return None
+
+# linux ioctl cloning a file's extents, copy on write in btrfs and xfs
+FICLONE = 0x40049409
+
+def clone_or_copy(source, target):
+    """copies source to target sharing its data blocks where the filesystem allows it"""
+    with open(source, 'rb') as source_file:
+        with open(target, 'wb') as target_file:
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+                return
+            except (IOError, OSError):
+                pass
+            shutil.copyfileobj(source_file, target_file, 1 << 20)
+
+def image_versions(args):
+    """writes an image's filebrowser versions next to it, named like filebrowser does, skipping existing ones.
+       it is a module function so that it can be sent to worker processes. Returns the versions written."""
+    path, versions = args
+    root, ext = os.path.splitext(path)
+    try:
+        image = Image.open(path)
+        image.load()
+    except Exception:
+        return 0
+    written = 0
+    for name, version in versions.items():
+        version_path = '{}_{}{}'.format(root, name, ext)
+        if os.path.exists(version_path):
+            continue
+        size = (version.get('width') or image.size[0], version.get('height') or image.size[1])
+        if 'crop' in (version.get('opts') or '') and version.get('width') and version.get('height'):
+            thumbnail = ImageOps.fit(image, size, Image.ANTIALIAS)
+        else:
+            thumbnail = image.copy()
+            thumbnail.thumbnail(size, Image.ANTIALIAS)
+        try:
+            thumbnail.save(version_path)
+            written += 1
+        except Exception:
+            pass
+    return written
+
+# slugify results by value, names repeat a lot among pictures and categories
+slugify_cache = {}
+slugify_cache_size = 100000
+
+def cached_slugify(value):
+    if value not in slugify_cache:
+        if len(slugify_cache) >= slugify_cache_size:
+            slugify_cache.clear()
+        slugify_cache[value] = slugify(value)
+    return slugify_cache[value]
+
+class UniqueValues(object):
+    """Hands out values not taken yet, starting from those taken in the database. A taken value gets
+       a counter with template, and each value remembers the last counter it got, so the next repeated one
+       doesn't check them all again. normalize gives the value compared, e.g. for case insensitive names."""
+
+    def __init__(self, taken=(), template=u'{}-{}', normalize=None):
+        self.normalize = normalize or (lambda value: value)
+        self.template = template
+        self.taken = set(self.normalize(value) for value in taken)
+        self.counters = {}
+
+    def unique(self, value):
+        key = self.normalize(value)
+        counter = self.counters.get(key, 1)
+        candidate = value
+        while self.normalize(candidate) in self.taken:
+            counter += 1
+            candidate = self.template.format(value, counter)
+        self.counters[key] = counter
+        self.taken.add(self.normalize(candidate))
+        return candidate
+
+class PhaseCounters(object):
+    """rows read and written, and queries run by other threads, during a phase for --metrics-out."""
+
+    def __init__(self):
+        self.rows_read = 0
+        self.rows_written = Counter()
+        self.queries = 0
+
+# the counters of the phase running in each thread, threads working for a phase share its counters
+phase_counters = threading.local()
+
+def current_counters():
+    counters = getattr(phase_counters, 'current', None)
+    if counters is None:
+        counters = phase_counters.current = PhaseCounters()
+    return counters
+
+class RowsReadMixin(object):
+    """counts the rows fetched by cursors in the counters of the phase that created them, for --metrics-out.
+       pymysql's rownumber is the number of rows fetched since the last execute."""
+
+    def __init__(self, *args, **kwargs):
+        super(RowsReadMixin, self).__init__(*args, **kwargs)
+        self._counters = current_counters()
+
+    def execute(self, query, args=None):
+        self._count_rows()
+        return super(RowsReadMixin, self).execute(query, args)
+
+    def close(self):
+        self._count_rows()
+        super(RowsReadMixin, self).close()
+
+    def _count_rows(self):
+        self._counters.rows_read += self.rownumber or 0
+        self.rownumber = 0
+
+class DictCursor(RowsReadMixin, pymysql.cursors.DictCursor):
+    pass
+
+class SSDictCursor(RowsReadMixin, pymysql.cursors.SSDictCursor):
+    pass
+
+# select conditions are (field, operator, value) triples that must all hold,
+# or (None, 'OR', conditions) when any of them is enough
+comparisons = {'=': operator.eq, '>': operator.gt, '>=': operator.ge, '<': operator.lt, 'IN': lambda a, b: a in b}
+
+def where_sql(where, glue=' AND '):
+    """renders select conditions as a SQL WHERE clause and its params."""
+    clauses = []
+    params = []
+    for field, op, value in where:
+        if op == 'OR':
+            clause, clause_params = where_sql(value, ' OR ')
+            clauses.append('({})'.format(clause))
+            params += clause_params
+        elif op == 'IN':
+            clauses.append('`{}` IN ({})'.format(field, ', '.join(['%s'] * len(value))))
+            params += list(value)
+        else:
+            clauses.append('`{}` {} %s'.format(field, op))
+            params.append(value)
+    return glue.join(clauses), params
+
+def where_match(row, where, any_of=False):
+    """evaluates select conditions on a row dict, NULLs don't match like in SQL."""
+    for field, op, value in where:
+        if op == 'OR':
+            matched = where_match(row, value, True)
+        else:
+            matched = row[field] is not None and comparisons[op](row[field], value)
+        if matched == any_of:
+            return matched
+    return not any_of
+
+class MySQLSource(object):
+    """Joomla's tables in a MySQL server."""
+
+    def __init__(self, cnx, prefix):
+        self.cnx = cnx
+        self.prefix = prefix
+
+    def select(self, table, fields, where=(), order_by=None, limit=None, offset=None, unbuffered=False):
+        """returns a cursor with the rows of table as dicts of the given fields, order_by is a field or a tuple of them.
+           unbuffered uses a server side cursor, rows are sent as we fetch them instead of all at once."""
+        # we need to quote field names because fulltext is a reserved mysql keyword
+        query = "SELECT {} FROM {}{}".format(', '.join('`{}`'.format(field) for field in fields), self.prefix, table)
+        conditions, params = where_sql(where)
+        if conditions:
+            query += " WHERE " + conditions
+        if order_by:
+            if isinstance(order_by, basestring):
+                order_by = (order_by,)
+            query += " ORDER BY " + ', '.join('`{}`'.format(field) for field in order_by)
+        if limit is not None:
+            query += " LIMIT {}".format(int(limit))
+        if offset:
+            query += " OFFSET {}".format(int(offset))
+        cursor = self.cnx.cursor(SSDictCursor if unbuffered else DictCursor)
+        cursor.execute(query, params or None)
+        return cursor
+
+    def cursor(self, *args):
+        """for queries only a server can answer, like --plan aggregates."""
+        return self.cnx.cursor(*args)
+
+    def now(self):
+        """Joomla's clock"""
+        cursor = self.cnx.cursor()
+        cursor.execute("SELECT NOW() AS now")
+        now = cursor.fetchone()['now']
+        cursor.close()
+        return now.strftime('%Y-%m-%d %H:%M:%S')
+
+    def count(self, table):
+        cursor = self.cnx.cursor()
+        cursor.execute("SELECT COUNT(*) AS n FROM {}{}".format(self.prefix, table))
+        count = cursor.fetchone()['n']
+        cursor.close()
+        return count
+
+    def max(self, table, column):
+        cursor = self.cnx.cursor()
+        cursor.execute("SELECT MAX(`{}`) AS n FROM {}{}".format(column, self.prefix, table))
+        value = cursor.fetchone()['n']
+        cursor.close()
+        return value
+
+    def close(self):
+        self.cnx.close()
+
+# mysqldump string escapes, \% and \_ are kept as they are
+dump_escapes = {'0': u'\0', 'b': u'\b', 'n': u'\n', 'r': u'\r', 't': u'\t', 'Z': u'\x1a', '%': u'\\%', '_': u'\\_'}
+dump_escape_re = re.compile(r"\\(.)|''", re.S)
+# a quoted string, NULL, or a number, followed by the next value's comma or the row's closing parenthesis
+dump_value_re = re.compile(r"\s*(?:(?:_binary\s*)?'((?:[^'\\]+|\\.|'')*)'|(NULL)|([^,()\s]+))\s*([,)])", re.S)
+dump_int_types = ('tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint', 'year')
+dump_float_types = ('float', 'double', 'real')
+
+def dump_unescape(match):
+    if match.group(1) is None:
+        return u"'"
+    return dump_escapes.get(match.group(1), match.group(1))
+
+def dump_rows(values):
+    """parses the VALUES list of an INSERT, (1,'a',NULL),(2,'b',NULL);
+       yields each row as a list of unicode strings and Nones."""
+    pos = values.find('(')
+    while pos != -1:
+        pos += 1
+        row = []
+        while True:
+            match = dump_value_re.match(values, pos)
+            if not match:
+                raise CommandError("Can't parse dump values near: {}".format(values[pos:pos+80].encode('utf-8')))
+            string, null, literal, end = match.groups()
+            if string is not None:
+                row.append(dump_escape_re.sub(dump_unescape, string))
+            elif null:
+                row.append(None)
+            elif literal.startswith('0x'):
+                row.append(literal[2:].decode('hex').decode('utf-8', 'replace'))
+            else:
+                row.append(literal)
+            pos = match.end()
+            if end == ')':
+                break
+        yield row
+        pos = values.find('(', pos)
+
+def dump_value(value, column_type):
+    """converts a dump value like pymysql does with the column's type, zero dates become None."""
+    if value is None:
+        return None
+    if column_type in dump_int_types:
+        return int(value)
+    if column_type in dump_float_types:
+        return float(value)
+    if column_type == 'decimal':
+        return Decimal(value)
+    if column_type in ('datetime', 'timestamp', 'date'):
+        if value.startswith('0000-00-00'):
+            return None
+        if column_type == 'date':
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        return datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    return value
+
+class DumpCursor(object):
+    """cursor like access to the rows selected from a dump."""
+
+    def __init__(self, rows):
+        self._rows = rows
+        self._counters = current_counters()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        row = next(self._rows)
+        self._counters.rows_read += 1
+        return row
+
+    def fetchone(self):
+        return next(self, None)
+
+    def fetchmany(self, size):
+        return list(islice(self, size))
+
+    def fetchall(self):
+        return list(self)
+
+    def close(self):
+        self._rows.close()
+
+class DumpSource(object):
+    """Joomla's tables in a mysqldump file, plain or gzipped, read without a MySQL server.
+       Rows are parsed from the table's INSERT statements as the file is read, a line at a time,
+       so memory doesn't grow with the dump. mysqldump writes each statement in a line,
+       and the rows of InnoDB tables in primary key order. Rows in any other statement,
+       or an INSERT continued in the next line, stop the migration instead of being skipped.
+       Seeking in a gzipped dump decompresses it from the start, so the first read goes on to its end
+       and copies every table up to _spill_bytes into a plain temporary file, read instead afterwards.
+       Bigger tables are decompressed again on each read, --extract-to avoids it."""
+
+    _spill_bytes = 64 << 20
+
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+        # where each table's CREATE TABLE starts and its columns, found by previous reads
+        self._offsets = {}
+        self._columns = {}
+        # plain copies of the tables of a gzipped dump, once it was read to its end
+        self._gzipped = path.endswith('.gz')
+        self._spills = {}
+        self._spill_dir = None
+        self._scanned = False
+
+    def select(self, table, fields, where=(), order_by=None, limit=None, offset=None, unbuffered=False):
+        """like MySQLSource.select, conditions are evaluated in Python.
+           rows are streamed either way, and checked to be ordered instead of sorted."""
+        rows = self._table_rows(self.prefix + table, where)
+        if where:
+            rows = (row for row in rows if where_match(row, where))
+        if order_by:
+            rows = self._ordered(rows, table, order_by)
+        if limit is not None or offset:
+            start = int(offset or 0)
+            rows = islice(rows, start, start + int(limit) if limit is not None else None)
+        return DumpCursor(dict((field, row[field]) for field in fields) for row in rows)
+
+    def now(self):
+        """the dump has no clock, changes after it was written are synced next time."""
+        return datetime.fromtimestamp(os.path.getmtime(self.path)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def count(self, table):
+        """the rows are parsed to count them, one at a time"""
+        return sum(1 for row in self._table_rows(self.prefix + table))
+
+    def max(self, table, column):
+        """the greatest value of column in the table's rows as they're parsed, None if there are none"""
+        value = None
+        for row in self._table_rows(self.prefix + table):
+            if row[column] is not None and (value is None or row[column] > value):
+                value = row[column]
+        return value
+
+    def close(self):
+        if self._spill_dir:
+            shutil.rmtree(self._spill_dir, True)
+            self._spill_dir = None
+            self._spills.clear()
+
+    def _open(self):
+        if self._gzipped:
+            # GzipFile's own readline is slow
+            return BufferedReader(gzip.GzipFile(self.path, 'rb'), 1 << 20)
+        return open(self.path, 'rb')
+
+    def _table_rows(self, table, where=()):
+        """generator of table's rows as dicts. The dump is read from the table's CREATE TABLE when
+           a previous read went past it, and up to the next table. where is evaluated by select,
+           sources that can skip rows without reading them use it too."""
+        insert = 'INSERT INTO `{}` '.format(table)
+        columns = None
+        current = None
+        spill_path = self._spills.get(table)
+        if spill_path:
+            dump = open(spill_path, 'rb')
+        else:
+            dump = self._open()
+        scanning = self._gzipped and not spill_path and not self._scanned
+        spill = None
+        try:
+            if not spill_path:
+                dump.seek(self._offsets.get(table, 0))
+            while True:
+                offset = dump.tell()
+                line = dump.readline()
+                if not line:
+                    if scanning:
+                        self._scanned = True
+                    break
+                if spill and not line.startswith('CREATE TABLE'):
+                    spill = self._spill_line(spill, line)
+                if line.startswith('CREATE TABLE'):
+                    if spill:
+                        self._end_spill(spill, True)
+                        spill = None
+                    if columns is not None and not scanning:
+                        # the table's rows are over
+                        break
+                    name = current = line.split('`')[1]
+                    self._offsets.setdefault(name, offset)
+                    if scanning and name not in self._spills:
+                        spill = self._spill_line(self._start_spill(name), line)
+                    self._columns[name] = self._read_columns(dump, spill and spill[1])
+                    if name == table:
+                        columns = self._columns[name]
+                elif line.startswith(insert):
+                    if columns is None:
+                        raise CommandError("{} rows come before its CREATE TABLE in {}".format(table, self.path))
+                    if not line.rstrip().endswith(';'):
+                        raise CommandError("An INSERT of {} continues in the next line of {}, dump it with a statement per line".format(table, self.path))
+                    head, values = line[len(insert):].decode('utf-8', 'replace').split('VALUES', 1)
+                    row_columns = columns
+                    if head.strip():
+                        # mysqldump --complete-insert
+                        types = dict(columns)
+                        row_columns = [(name, types.get(name)) for name in re.findall('`([^`]+)`', head)]
+                    for row_values in dump_rows(values):
+                        yield dict((name, dump_value(value, column_type)) for (name, column_type), value in zip(row_columns, row_values))
+                elif current == table and line.startswith(('(', 'INSERT', 'REPLACE')):
+                    # e.g. INSERT IGNORE, REPLACE, or the rows of an INSERT split in lines
+                    raise CommandError("Can't parse {} rows in {}: {}".format(table, self.path, line[:80]))
+            if spill:
+                self._end_spill(spill, True)
+                spill = None
+        finally:
+            if spill:
+                # the read was abandoned, the table may be incomplete
+                self._end_spill(spill, False)
+            dump.close()
+        if columns is None:
+            raise CommandError("Table {} not found in {}".format(table, self.path))
+
+    def _start_spill(self, name):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='joomla2cyclope-')
+        fd, path = tempfile.mkstemp(suffix='.sql', dir=self._spill_dir)
+        return name, os.fdopen(fd, 'wb'), path
+
+    def _spill_line(self, spill, line):
+        """copies a line to the table's spill, which is dropped once the table is too big."""
+        name, spill_file, path = spill
+        spill_file.write(line)
+        if spill_file.tell() > self._spill_bytes:
+            self._end_spill(spill, False)
+            return None
+        return spill
+
+    def _end_spill(self, spill, complete):
+        name, spill_file, path = spill
+        spill_file.close()
+        if complete and name not in self._spills:
+            self._spills[name] = path
+        else:
+            os.remove(path)
+
+    def _read_columns(self, dump, spill_file=None):
+        """column names and types of a CREATE TABLE, up to its closing parenthesis.
+           Lines read are copied to spill_file if given."""
+        columns = []
+        for line in iter(dump.readline, ''):
+            if spill_file:
+                spill_file.write(line)
+            if line.startswith(')'):
+                break
+            match = re.match(r'\s*`([^`]+)`\s+(\w+)', line)
+            if match:
+                columns.append((match.group(1), match.group(2).lower()))
+        return columns
+
+    def _ordered(self, rows, table, order_by):
+        """sorting would hold the whole table in memory"""
+        if isinstance(order_by, basestring):
+            order_by = (order_by,)
+        key = operator.itemgetter(*order_by)
+        last = None
+        for row in rows:
+            if last is not None and key(row) < last:
+                raise CommandError("{}{} rows are not ordered by {} in the dump, use mysqldump --order-by-primary".format(
+                    self.prefix, table, ', '.join(order_by)))
+            last = key(row)
+            yield row
+
+class StagingSource(DumpSource):
+    """Joomla's tables extracted with --extract-to, read without a MySQL server. Each table is a file of
+       zlib compressed pickled chunks of rows, and index.json has their columns and where each chunk is,
+       with the least and greatest value of the table's key column in it. Files are memory mapped, so
+       only the chunks read are loaded, and those outside a where on the key column are skipped."""
+
+    def __init__(self, path, prefix):
+        super(StagingSource, self).__init__(path, prefix)
+        index_path = os.path.join(path, 'index.json')
+        if not os.path.exists(index_path):
+            raise CommandError("No extracted tables found in {}, use --extract-to first.".format(path))
+        with open(index_path) as index_file:
+            self.index = json.load(index_file)
+        if self.index['prefix'] != prefix:
+            raise CommandError("{} was extracted with prefix {}".format(path, self.index['prefix']))
+
+    def now(self):
+        """Joomla's clock when it was extracted"""
+        return self.index['extracted']
+
+    def count(self, table):
+        """the index knows how many rows each chunk has"""
+        return sum(chunk[2] for chunk in self._table_index(self.prefix + table)['chunks'])
+
+    def max(self, table, column):
+        """the greatest value of the chunks, for the key column"""
+        table_index = self._table_index(self.prefix + table)
+        if column != table_index['key']:
+            return super(StagingSource, self).max(table, column)
+        chunks = table_index['chunks']
+        return max(chunk[4] for chunk in chunks) if chunks else None
+
+    def _table_index(self, table):
+        if table not in self.index['tables']:
+            raise CommandError("Table {} wasn't extracted to {}".format(table, self.path))
+        return self.index['tables'][table]
+
+    def _table_rows(self, table, where=()):
+        table_index = self._table_index(table)
+        columns = table_index['columns']
+        chunks = [chunk for chunk in table_index['chunks'] if self._chunk_matches(chunk, table_index['key'], where)]
+        if not chunks:
+            return
+        with open(os.path.join(self.path, table + '.chunks'), 'rb') as chunks_file:
+            data = mmap.mmap(chunks_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset, length, rows, first, last in chunks:
+                    for row in pickle.loads(zlib.decompress(data[offset:offset + length])):
+                        yield dict(zip(columns, row))
+            finally:
+                data.close()
+
+    def _chunk_matches(self, chunk, key, where):
+        """False if no row of the chunk can match the conditions on its key column"""
+        offset, length, rows, first, last = chunk
+        for field, op, value in where:
+            if field != key:
+                continue
+            if op == '>' and last <= value or op == '>=' and last < value or op == '<' and first >= value:
+                return False
+            if op == '=' and not first <= value <= last:
+                return False
+        return True
 
 class Command(BaseCommand):
     help = """
@@ -29,6 +623,21 @@ class Command(BaseCommand):
 
     Required params are server host name, database name and database user and password.
     Optional params are joomla's table prefix.
+
+    Joomla's tables can also be read from a mysqldump file, without a MySQL server:
+    (cyclope_workenv)$ python manage.py joomla2cyclope --dump redeco.sql.gz --prefix wiphala_
+    A gzipped dump is decompressed again to read its content and other tables over 64 MB,
+    for big dumps extract them once with --dump redeco.sql.gz --extract-to and use --from-staging.
+
+    Joomla's tables can be extracted once, and migrated from the extracted files as many times as needed:
+    (cyclope_workenv)$ python manage.py joomla2cyclope --server localhost --database REDECO_JOOMLA --user root --extract-to redeco.staging
+    (cyclope_workenv)$ python manage.py joomla2cyclope --from-staging redeco.staging --plain
+
+    Many sites can be migrated at once from a JSON manifest, a list with the options of each site
+    (by their dest name, e.g. "db", "prefix", "dump") and its Cyclope "target" database settings:
+    (cyclope_workenv)$ python manage.py joomla2cyclope --manifest sites.json --site-workers 4
+    [{"name": "redeco", "db": "REDECO_JOOMLA", "user": "root", "prefix": "wiphala_",
+      "target": {"ENGINE": "django.db.backends.mysql", "NAME": "redeco_cyclope"}}, ...]
     
     This script makes use of libraries not included in Cyclope that need to be installed through pip
 
@@ -79,12 +688,66 @@ class Command(BaseCommand):
             default='',
             help='Joomla\'s tables prefix'
         ),
+        make_option('--dump',
+            action='store',
+            dest='dump',
+            default=None,
+            help='Read Joomla\'s tables from this mysqldump file (.sql or .sql.gz) instead of a MySQL server.'
+        ),
+        make_option('--extract-to',
+            action='store',
+            dest='extract_to',
+            default=None,
+            help='Extract the Joomla tables the migration reads into this directory, compressed, and exit.'
+        ),
+        make_option('--from-staging',
+            action='store',
+            dest='from_staging',
+            default=None,
+            help='Read Joomla\'s tables from a directory written by --extract-to, instead of MySQL.'
+        ),
         make_option('--default_password',
             action='store',
             dest='joomla_password',
             default=None,
             help='Default password for ALL users. Optional, otherwise usernames will be used.'
         ),
+        make_option('--unusable_passwords',
+            action='store_true',
+            dest='unusable_passwords',
+            default=False,
+            help='Users are created without a password, so they must reset it.'
+        ),
+        make_option('--joomla-root',
+            action='store',
+            dest='joomla_root',
+            default=None,
+            help='Joomla\'s installation directory, image files used by articles are copied from it into the media library.'
+        ),
+        make_option('--rewrite-links',
+            action='store_true',
+            dest='rewrite_links',
+            default=False,
+            help='Rewrite links to Joomla\'s articles, categories and menu items in articles text to their Cyclope urls.'
+        ),
+        make_option('--nested-sets',
+            action='store_true',
+            dest='nested_sets',
+            default=False,
+            help='Use Joomla\'s lft/rgt/level for Categories, Tags and Menu Items trees, rebuilding them only if they\'re not consistent.'
+        ),
+        make_option('--metrics-out',
+            action='store',
+            dest='metrics_out',
+            default=None,
+            help='Write time, CPU, rows, queries and memory used by each phase to this JSON file.'
+        ),
+        make_option('--plan',
+            action='store_true',
+            dest='plan',
+            default=False,
+            help='Don\'t migrate, estimate rows, memory and time of each phase from Joomla\'s tables.'
+        ),
         make_option('--devel',
             action='store_true',
             dest='devel',
@@ -108,149 +771,802 @@ class Command(BaseCommand):
             default=False,
             help='Strip article\'s contents HTML markup into plain text',
         ),
+        make_option('--batch-size',
+            action='store',
+            dest='batch_size',
+            default=1000,
+            help='Amount of Content rows read and saved at a time. Keeps memory usage bounded on large sites.'
+        ),
+        make_option('--workers',
+            action='store',
+            dest='workers',
+            default=1,
+            help='Number of processes parsing articles HTML for images.'
+        ),
+        make_option('--pipeline',
+            action='store_true',
+            dest='pipeline',
+            default=False,
+            help='Read, convert and write Content and Tag map batches at the same time, reading and writing in their own threads.'
+        ),
+        make_option('--shards',
+            action='store',
+            dest='shards',
+            default=1,
+            help='Number of processes migrating Content, each one a range of ids with its own connections.'
+        ),
+        make_option('--parallel-phases',
+            action='store',
+            dest='parallel_phases',
+            default=1,
+            help='Number of phases run at the same time, once the phases they depend on are finished. Each one reads Joomla with its own connection.'
+        ),
+        make_option('--phases',
+            action='store',
+            dest='phases',
+            default=None,
+            help='Comma separated phases to run, e.g. content,images. The phases they depend on must be finished by a previous run, continued with --resume.'
+        ),
+        make_option('--checkpoint',
+            action='store',
+            dest='checkpoint',
+            default=None,
+            help='Directory where the progress of each phase is recorded. Defaults to DATABASE+PREFIX.checkpoint'
+        ),
+        make_option('--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Skip phases finished by a previous run and continue Content from the last migrated article.'
+        ),
+        make_option('--since',
+            action='store',
+            dest='since',
+            default=None,
+            help='Only sync Content, Categories, Tags and Tag maps modified after this date (YYYY-MM-DD HH:MM:SS) into an already migrated site.'
+        ),
+        make_option('--sync',
+            action='store_true',
+            dest='sync',
+            default=False,
+            help='Like --since, using the date of the last migration or sync as watermark.'
+        ),
+        make_option('--verify',
+            action='store_true',
+            dest='verify',
+            default=False,
+            help='Compare a finished migration with Joomla, reporting missing, extra and different rows.'
+        ),
+        make_option('--manifest',
+            action='store',
+            dest='manifest',
+            default=None,
+            help='Migrate each site listed in this JSON file, the rest of the options apply to all of them.'
+        ),
+        make_option('--site-workers',
+            action='store',
+            dest='site_workers',
+            default=1,
+            help='Number of sites of a --manifest migrated at the same time, each one in a process of its own and a target database of its own.'
+        ),
+        make_option('--report-out',
+            action='store',
+            dest='report_out',
+            default=None,
+            help='Where the combined report of a --manifest is written. Defaults to MANIFEST.report.json'
+        ),
+        make_option('--fast-load',
+            action='store_true',
+            dest='fast_load',
+            default=False,
+            help='Tune Cyclope\'s database for bulk loading while migrating: each phase is a single transaction, '
+                 'secondary indexes are created at the end and foreign key checks are deferred, then integrity is checked. '
+                 'A crash during a SQLite load can corrupt its file, keep a copy.'
+        ),
     )
     
     # CLASS CONSTANTS
     table_prefix = None
     joomla_password = None
+    unusable_passwords = False
+    _default_password_hash = None
+    nested_sets = False
+    joomla_root = None
+    rewrite_links = False
+    # Joomla id to Cyclope slug or url, by kind of link
+    _link_index = None
+    _article_url = u'/article/{}/'
+    _category_url = u'/category/{}/'
+    _menuitem_url = u'/{}/'
+    # threads reading, hashing and copying image files
+    _ingest_threads = 8
+    _ingest_pool = None
+    _thumbnail_pool = None
+    # model name to the ids of its rows in Cyclope, see _registered
+    _registry = None
+    # model name, or collection id for category names, to the values taken, see _unique_slug
+    _slugs = None
+    _category_names = None
+    metrics = None
     devel_url = False
+    batch_size = 1000
+    workers = 1
+    pipeline = False
+    # batches waiting in each pipeline queue, a slow writer holds the reader back
+    _pipeline_depth = 4
+    parallel_phases = 1
+    shards = 1
+    # content batches are part of the phase transaction instead of committing on their own, see --fast-load
+    _content_atomic = False
+    checkpoint_dir = None
+    _checkpoint = None
+    # the content state on disk while the content phase runs in a transaction, see _run_phase
+    _committed_content = None
+    # the checkpoint state and images spool files, sharded content processes have their own
+    _state_name = 'state.json'
+    _spool_name = 'images.jsonl'
+    fast_load = False
+    # session settings applied by --fast-load to every connection, and restored afterwards.
+    # Django creates PostgreSQL's foreign keys DEFERRABLE INITIALLY DEFERRED, they're checked once when a phase commits
+    _fast_load_settings = {
+        'sqlite': (('journal_mode', 'MEMORY'), ('synchronous', 'OFF'), ('cache_size', '-262144')),
+        'postgresql': (('synchronous_commit', 'off'),),
+        'mysql': (('foreign_key_checks', '0'),),
+    }
+    _restore_settings = None
+    _sync_min_id = None
     # menus
     _menu_category_view = 'teaser_list'
     _menu_category_view_options = '{"sort_by": "DATE+", "show_title": false, "show_description": false, "show_image": false, "items_per_page": 10, "limit_to_n_items": 0, "simplified": false, "traverse_children": true, "navigation": "DISABLED"}'
     _category_content_type = None
     _article_content_type = None
+    # rows sent at a time by _bulk_insert, SQLite's executemany sends one row per statement anyway
+    _bulk_insert_rows = {'postgresql': 10000, 'mysql': 1000, 'sqlite': 5000, 'default': 1000}
+    # rows updated by each _bulk_update_parents statement, with 3 params each it stays below SQLite's 999
+    _bulk_update_rows = 300
+    # rough rows per second of each phase, and memory taken by a model instance, for --plan estimates
+    _plan_rows_per_second = {'users': 5000, 'menus': 500, 'menuitems': 2000, 'categories': 3000, 'tags': 3000,
+                             'modules': 2000, 'content': 1500, 'tag_map': 10000, 'images': 4000}
+    _plan_instance_bytes = 2048
+    _plan_sample_size = 200
+    # tables extracted by --extract-to, with the columns read by any phase and the column rows are ordered by
+    _staging_tables = (
+        ('users', ('id', 'username', 'name', 'email', 'registerDate', 'lastvisitDate'), 'id'),
+        ('menu_types', ('id', 'menutype', 'title', 'description'), 'id'),
+        ('menu', ('id', 'menutype', 'title', 'alias', 'path', 'link', 'published', 'parent_id', 'level', 'lft', 'rgt', 'home'), 'id'),
+        ('categories', ('id', 'path', 'title', 'alias', 'description', 'published', 'parent_id', 'lft', 'rgt', 'level',
+                        'extension', 'modified_time'), 'id'),
+        ('tags', ('id', 'parent_id', 'lft', 'rgt', 'level', 'title', 'published', 'modified_time'), 'id'),
+        ('modules', ('id', 'title', 'note', 'content', 'published', 'publish_up', 'module'), 'id'),
+        ('content', ('id', 'title', 'alias', 'introtext', 'fulltext', 'created', 'modified', 'state', 'catid', 'created_by', 'images'), 'id'),
+        ('contentitem_tag_map', ('type_alias', 'type_id', 'content_item_id', 'tag_id', 'tag_date'), 'content_item_id'),
+    )
+    # content_item_id has no index of its own, the map is read in the order of its unique key
+    _staging_order = {'contentitem_tag_map': ('type_id', 'content_item_id')}
+    _staging_chunk_rows = 5000
+    # ids of each kind of difference kept for the --verify report
+    _verify_report_ids = 20
+    # each phase and the phases it needs finished, in an order that runs them one at a time.
+    # menu items link to categories, tag categories continue their trees, articles need their users and categories
+    # (and menu items with --rewrite-links, added by _configure),
+    # the tag map count excludes articles categorizations, and images come from the content phase
+    _phase_dependencies = (
+        ('users', ()),
+        ('menus', ()),
+        ('collections', ()),
+        ('categories', ('collections',)),
+        ('menuitems', ('menus', 'categories')),
+        ('tags', ('categories',)),
+        ('modules', ()),
+        ('content', ('users', 'categories')),
+        ('tag_map', ('tags', 'content')),
+        ('images', ('content',)),
+    )
     # categories
     _categories_collection = 1
     _tags_collection = 2   
     
     def handle(self, *args, **options):
         """Joomla to Cyclope database migration logic"""
+
+        if options.get('manifest'):
+            self._migrate_sites(options)
+            return
         
-        self.table_prefix = options['prefix']
-        self.joomla_password = options['joomla_password']
-        self.devel_url = options['devel']
-        self.strip_html = options['plain']
+        self._configure(options)
 
         nlimit = options['limit']
         offset = options['offset']
         if offset and not nlimit:
             raise Exception("To specify an offset, the nlimit must be supplied too.")
 
-        self._category_content_type = ContentType.objects.get(model='category').pk
-        self._article_content_type = ContentType.objects.get(model='article').pk
-
-        # MySQL connection
-        cnx = self._mysql_connection(options['server'], options['db'], options['user'], options['password'])
-        print "connected to Joomla's MySQL database..."
+        since = options['since']
+        if options['sync'] and not since:
+            since = self._load_watermark()['since']
+        if since:
+            since = self._parse_date(since)
+
+        cnx = self._joomla_source(options)
+
+        if options['plan']:
+            if not isinstance(cnx, MySQLSource):
+                raise CommandError("--plan needs Joomla's MySQL database, it can't estimate from a dump.")
+            self._plan(cnx)
+            cnx.close()
+            return
+
+        if options['verify']:
+            self._verify(cnx)
+            cnx.close()
+            return
+
+        if options['extract_to']:
+            self._extract(cnx, options['extract_to'])
+            cnx.close()
+            return
         
         start = time.time() # T
+        # Joomla's clock, the watermark for the next sync
+        sync_start = cnx.now()
 
-        self._site_settings_setter()
+        if since:
+            with self._fast_loading():
+                self._sync(cnx, since, start)
+            self._save_watermark(sync_start, self._sync_min_id)
+            cnx.close()
+            self._write_metrics(options['metrics_out'], start)
+            return
 
-        user_count = self._fetch_users(cnx)
-        print "-> {} Usuarios migrados".format(user_count)
-        self._time_from(start)
+        self._load_checkpoint(options['resume'], sync_start)
+        phases = self._phases_to_run()
 
-        menus_count, menu_types = self._fetch_menus(cnx)
-        menuitem_count = self._fetch_menuitems(cnx, menu_types)
-        print "-> {} Menus migrados.".format(menus_count)
-        print "-> {} Items de Menu migrados.".format(menuitem_count)
-        self._time_from(start)
-        
-        self._create_collections()
-        print "-> Colecciones creadas"
+        self._site_settings_setter()
 
-        categories_count = self._fetch_categories(cnx)
-        print "-> {} Categorias migradas de Categorias Joomla".format(categories_count)
-        self._time_from(start)
-        
         min_tag_id = self._fetch_min_id(cnx)
-        tags_count = self._fetch_categories_from_tags(cnx, min_tag_id)
-        print "-> {} Categorias migradas de Tags Joomla".format(tags_count)
+        tasks = self._phase_tasks(min_tag_id, nlimit, offset)
+        with self._fast_loading():
+            results, durations = self._run_phases(tasks, cnx, self._open_source, phases)
+
+        # with --phases only those that ran, and the ones they needed, have results
+        if 'users' in results:
+            print "-> {} Usuarios migrados".format(results['users'])
+        if 'menus' in results:
+            menus_count, menu_types = results['menus']
+            print "-> {} Menus migrados.".format(menus_count)
+        if 'menuitems' in results:
+            print "-> {} Items de Menu migrados.".format(results['menuitems'])
+        if 'collections' in results:
+            print "-> Colecciones creadas"
+        if 'categories' in results:
+            print "-> {} Categorias migradas de Categorias Joomla".format(results['categories'])
+        if 'tags' in results:
+            print "-> {} Categorias migradas de Tags Joomla".format(results['tags'])
+        if 'modules' in results:
+            print "-> {} Bloques HTML migrados de Modulos Joomla".format(results['modules'])
+        if 'content' in results:
+            articles_count, img_success = results['content']
+            print "-> {} Articulos migrados".format(articles_count)
+            print "-> {}% Imgs ok".format(img_success)
+            # articles categorizations are saved along with each batch of articles
+            print "-> {} Articulos categorizados".format(self._checkpoint['content'].get('categorizations', 0))
+        if 'tag_map' in results:
+            print "-> {} Tags como categorizaciones".format(results['tag_map'])
+        if 'images' in results:
+            images_count, related_count, article_images_count = results['images']
+            print "-> {} Imagenes migradas".format(images_count)
+            print "-> {} Imagenes de articulos".format(article_images_count)
+            print "-> {} Imagenes como contenido relacionado".format(related_count)
+        self._print_critical_path(durations)
         self._time_from(start)
 
-        htmls_count = self._fetch_modules(cnx)
-        print "-> {} Bloques HTML migrados de Modulos Joomla".format(htmls_count)
-
-        articles_count, articles_images, articles_categorizations, img_success = self._fetch_content(cnx, nlimit, offset)
-        print "-> {} Articulos migrados".format(articles_count)
-        self._time_from(start)
-        print "-> {}% Imgs ok".format(img_success)
-        
-        categorizations_count = self._mass_categorization(articles_categorizations)
-        print "-> {} Articulos categorizados".format(categorizations_count)
-        self._time_from(start)
-
-        tag_categorizations_count = self._fetch_categorizations_from_tag_map(cnx, min_tag_id)
-        tag_categorizations_count -= categorizations_count
-        print "-> {} Tags como categorizaciones".format(tag_categorizations_count)
-        
-        images_count, related_count, article_images_count = self._create_images(articles_images)
-        print "-> {} Imagenes migradas".format(images_count)
-        print "-> {} Imagenes de articulos".format(article_images_count)
-        print "-> {} Imagenes como contenido relacionado".format(related_count)
-        self._time_from(start)
+        # a resumed migration keeps the start of the first run, changes since then will be synced
+        if len(self._checkpoint['phases']) == len(self._phase_dependencies):
+            self._save_watermark(self._checkpoint['started'], min_tag_id)
         
         #close mysql connection
         cnx.close()
+        self._write_metrics(options['metrics_out'], start)
         
+    def _configure(self, options):
+        """sets the command's attributes from its options, they're also used to run phases on their own."""
+        self.table_prefix = options['prefix']
+        self.joomla_password = options['joomla_password']
+        self.unusable_passwords = options['unusable_passwords']
+        self.nested_sets = options['nested_sets']
+        self.joomla_root = options['joomla_root']
+        self.rewrite_links = options['rewrite_links'] and not options['plain']
+        if self.rewrite_links:
+            # links are rewritten with an index of the migrated menu items
+            self._phase_dependencies = tuple((name, dependencies + ('menuitems',) if name == 'content' else dependencies)
+                                             for name, dependencies in Command._phase_dependencies)
+        self.devel_url = options['devel']
+        self.strip_html = options['plain']
+        self.batch_size = int(options['batch_size'])
+        self.workers = int(options['workers'])
+        self.pipeline = options['pipeline']
+        source_name = self._source_name(options)
+        self.checkpoint_dir = options['checkpoint'] or self._default_checkpoint(options)
+        self.parallel_phases = int(options['parallel_phases'])
+        self.phases = options['phases'].split(',') if options.get('phases') else None
+        if self.parallel_phases > 1 and connection.vendor == 'sqlite':
+            print "SQLite allows a single writer, phases will run one at a time"
+            self.parallel_phases = 1
+        self.shards = int(options['shards'])
+        if self.shards > 1 and connection.vendor == 'sqlite':
+            print "SQLite allows a single writer, content will be migrated by one process"
+            self.shards = 1
+        self.fast_load = options['fast_load']
+        self._content_atomic = self.fast_load and not self.pipeline and self.shards <= 1
+        # phases running on their own and content shards read Joomla with their own connection
+        self._open_source = lambda: self._joomla_source(options)
+        self._checkpoint_lock = threading.RLock()
+        self._registry = {}
+        self._registry_lock = threading.Lock()
+        self._slugs = {}
+        self._category_names = {}
+        self._orphans = Counter()
+        if options['metrics_out']:
+            self.metrics = {'database': source_name, 'prefix': self.table_prefix, 'batch_size': self.batch_size, 'workers': self.workers,
+                            'parallel_phases': self.parallel_phases, 'shards': self.shards, 'phases': []}
+            # Django only logs queries in DEBUG mode otherwise
+            connection.use_debug_cursor = True
+
+        self._category_content_type = ContentType.objects.get(model='category').pk
+        self._article_content_type = ContentType.objects.get(model='article').pk
+
+    def _source_name(self, options):
+        return options['db'] or os.path.basename((options['dump'] or options['from_staging'] or '').rstrip('/'))
+
+    def _default_checkpoint(self, options):
+        return '{}{}.checkpoint'.format(self._source_name(options), options['prefix'])
+
+    def _joomla_source(self, options):
+        """Joomla's tables are read from a dump when given, otherwise from MySQL."""
+        if options['from_staging']:
+            print "reading Joomla's tables extracted to {}...".format(options['from_staging'])
+            return StagingSource(options['from_staging'], self.table_prefix)
+        if options['dump']:
+            print "reading Joomla's tables from {}...".format(options['dump'])
+            return DumpSource(options['dump'], self.table_prefix)
+        cnx = self._mysql_connection(options['server'], options['db'], options['user'], options['password'])
+        print "connected to Joomla's MySQL database..."
+        return MySQLSource(cnx, self.table_prefix)
+
     def _mysql_connection(self, host, database, user, password):
         """Establish a MySQL connection to the given option params and return it"""
         password = password if password else ""
         cnx = pymysql.connect(
-            host='localhost',
+            host=host or 'localhost',
             user=user,
             password=password,
             db=database,
             charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor
+            cursorclass=DictCursor
         )
         return cnx
 
+    # SITES
+
+    def _migrate_sites(self, options):
+        """Migrates the sites of a manifest, up to site_workers at a time. Each one is migrated by a process
+           forked from this one, so Django is set up only once, with its own connections and Cyclope database.
+           A failed site doesn't stop the others, the outcome of each one is written to a combined report."""
+        with open(options['manifest']) as manifest_file:
+            sites = json.load(manifest_file)
+        if not isinstance(sites, list) or not all(isinstance(site, dict) for site in sites):
+            raise CommandError("The manifest must be a JSON list with the options of each site.")
+        # a misspelled option would be silently ignored, like "databse" instead of "db"
+        keys = set(option.dest for option in self.option_list) - set(['manifest', 'site_workers', 'report_out'])
+        keys.update(('name', 'target'))
+        for site in sites:
+            unknown = sorted(set(site) - keys)
+            if unknown:
+                raise CommandError("Site {} has unknown options {}, they're named by their dest, like db or prefix.".format(
+                    site.get('name', site), ', '.join(unknown)))
+            if not site.get('db') and not site.get('dump') and not site.get('from_staging'):
+                raise CommandError("Site {} needs a db, a dump or a from_staging.".format(site.get('name', site)))
+        site_workers = int(options['site_workers'])
+        if site_workers > 1 and len(sites) > 1:
+            # sites migrated at once into the same database would wipe each other's content
+            targets = {}
+            for site in sites:
+                name = site.get('name', site)
+                if not site.get('target'):
+                    raise CommandError("Site {} needs a target to be migrated along other sites, with --site-workers.".format(name))
+                target = dict(settings.DATABASES['default'], **site['target'])
+                database = tuple(target.get(key) for key in ('ENGINE', 'HOST', 'PORT', 'NAME'))
+                if database in targets:
+                    raise CommandError("Sites {} and {} have the same target database, they can't be migrated at once.".format(
+                        targets[database], name))
+                targets[database] = name
+        start = time.time()
+        # nothing is opened by this process, forked ones would share it
+        connection.close()
+        pending = list(sites)
+        running = []
+        while pending or running:
+            while pending and len(running) < site_workers:
+                site = pending.pop(0)
+                site_options = self._site_options(options, site)
+                # a previous run's outcome isn't this one's
+                for path in (os.path.join(site_options['checkpoint'], 'report.json'), site_options['metrics_out']):
+                    if os.path.exists(path):
+                        os.remove(path)
+                process = Process(target=self._migrate_site, args=(site_options, site.get('target')))
+                process.start()
+                running.append((process, site_options))
+                print "migrating site {}...".format(site_options['site'])
+            for process, site_options in list(running):
+                process.join(0.1)
+                if process.exitcode is not None:
+                    running.remove((process, site_options))
+                    report = self._site_report(site_options, process.exitcode)
+                    print "-> sitio {}: {}, {:.2f} s".format(report['site'], report['status'], report.get('wall_time', 0))
+        reports = [self._site_report(self._site_options(options, site)) for site in sites]
+        failed = [report['site'] for report in reports if report['status'] != 'ok']
+        report_path = options['report_out'] or options['manifest'] + '.report.json'
+        with open(report_path, 'w') as report_file:
+            json.dump({'manifest': options['manifest'], 'wall_time': time.time() - start,
+                       'ok': len(reports) - len(failed), 'failed': failed, 'sites': reports}, report_file, indent=2)
+        print "-> {} sitios migrados, {} fallidos".format(len(reports) - len(failed), len(failed))
+        print "report written to {}".format(report_path)
+        self._time_from(start)
+
+    def _site_options(self, options, site):
+        """a site's options are the command's, overridden by the manifest's. It gets its own
+           checkpoint directory, where its log, metrics and report are written."""
+        site_options = dict(options)
+        site_options.update((key, value) for key, value in site.items() if key not in ('name', 'target'))
+        site_options['manifest'] = None
+        site_options['site'] = site.get('name') or '{}{}'.format(self._source_name(site_options), site_options['prefix'])
+        site_options['checkpoint'] = site.get('checkpoint') or self._default_checkpoint(site_options)
+        site_options['metrics_out'] = os.path.join(site_options['checkpoint'], 'metrics.json')
+        return site_options
+
+    def _migrate_site(self, options, target):
+        """Runs in a forked process, migrating a site into its target database, output goes to the site's log."""
+        if not os.path.isdir(options['checkpoint']):
+            os.makedirs(options['checkpoint'])
+        sys.stdout = sys.stderr = open(os.path.join(options['checkpoint'], 'migration.log'), 'w', 0)
+        report = {'site': options['site'], 'status': 'failed'}
+        start = time.time()
+        try:
+            if target:
+                self._use_database(target)
+            self.handle(**options)
+            report['status'] = 'ok'
+        except Exception as error:
+            traceback.print_exc()
+            report['error'] = '{}: {}'.format(type(error).__name__, error)
+        finally:
+            connection.close()
+            report['wall_time'] = time.time() - start
+            with open(os.path.join(options['checkpoint'], 'report.json'), 'w') as report_file:
+                json.dump(report, report_file)
+        # the exit code tells the parent how it went
+        sys.exit(0 if report['status'] == 'ok' else 1)
+
+    def _use_database(self, target):
+        """replaces Cyclope's default database settings, before anything connects to it."""
+        connection.close()
+        connections.databases['default'] = dict(settings.DATABASES['default'], **target)
+        connections.ensure_defaults('default')
+        if hasattr(connections._connections, 'default'):
+            del connections._connections.default
+        # content types are cached by id, and ids may differ between databases
+        ContentType.objects.clear_cache()
+
+    def _site_report(self, options, exitcode=None):
+        """the report written by a site's process, with the metrics of its phases."""
+        checkpoint = options['checkpoint']
+        report_path = os.path.join(checkpoint, 'report.json')
+        if os.path.exists(report_path):
+            with open(report_path) as report_file:
+                report = json.load(report_file)
+        else:
+            report = {'site': options['site'], 'status': 'crashed', 'exitcode': exitcode}
+        report['log'] = os.path.join(checkpoint, 'migration.log')
+        if os.path.exists(options['metrics_out']):
+            with open(options['metrics_out']) as metrics_file:
+                report['metrics'] = json.load(metrics_file)
+        return report
+
     # QUERIES
 
     def _fetch_users(self, mysql_cnx):
         """Joomla Users to Cyclope
-           Are users treated as authors in Joomla?"""
+           Are users treated as authors in Joomla?
+           Users are saved in batches, existing ones are updated."""
         fields = ('id', 'username', 'name', 'email', 'registerDate', 'lastvisitDate') # userType
-        query = "SELECT {} FROM {}users".format(fields, self.table_prefix)
-        query = self._clean_tuple(query)
-        cursor = mysql_cnx.cursor()
-        cursor.execute(query)
-        for user_hash in cursor:
-            user = self._user_to_user(user_hash)
-            user.save()
+        user_fields = ('username', 'first_name', 'email', 'is_staff', 'is_active', 'is_superuser', 'last_login', 'date_joined', 'password')
+        cursor = mysql_cnx.select('users', fields, unbuffered=True)
+        # hashing each username is the expensive part
+        per_user_hash = not (self.unusable_passwords or self.joomla_password)
+        pool = Pool(self.workers) if self.workers > 1 and per_user_hash else None
+        user_count = 0
+        for user_hashes in self._cursor_batches(cursor):
+            users = [self._user_to_user(user_hash) for user_hash in user_hashes]
+            self._hash_passwords(users, pool)
+            user_count += sum(self._upsert(User, users, user_fields))
         cursor.close()
-        return User.objects.count()
+        if pool:
+            pool.close()
+            pool.join()
+        return user_count
+
+    def _hash_passwords(self, users, pool=None):
+        """A default password is hashed only once and shared by all users,
+           otherwise each username is hashed, in the pool's worker processes when given."""
+        if self.unusable_passwords:
+            # no hashing involved
+            hashes = [make_password(None) for user in users]
+        elif self.joomla_password:
+            if not self._default_password_hash:
+                self._default_password_hash = make_password(self.joomla_password)
+            hashes = [self._default_password_hash] * len(users)
+        elif pool:
+            usernames = [user.username for user in users]
+            hashes = pool.map(make_password, usernames, max(1, len(users) / (self.workers * 4)))
+        else:
+            hashes = [make_password(user.username) for user in users]
+        for user, password in zip(users, hashes):
+            user.password = password
 
     def _fetch_content(self, mysql_cnx, nlimit, offset):
-        """Queries Joomla's _content table to populate Articles."""
-        articles = []
-        articles_images = []
-        articles_categorizations = []
+        """Queries Joomla's _content table to populate Articles.
+           Rows are streamed from an unbuffered cursor and saved batch_size at a time,
+           together with their categorizations, so memory doesn't grow with the table size.
+           Each saved batch is recorded in the checkpoint, and found images are spooled to disk for the images phase.
+           With --pipeline batches are read and written in their own threads while others are converted,
+           and with --shards ranges of ids are migrated by processes of their own.
+           A migration started with or without shards is resumed the same way, whatever --shards is given."""
+        content_state = self._checkpoint['content']
+        if self.rewrite_links:
+            self._load_link_index(mysql_cnx)
+        limit = int(nlimit) if nlimit else None
+        if content_state.get('shards') or (self.shards > 1 and not content_state['count']):
+            self._fetch_content_shards(mysql_cnx, limit, offset)
+        else:
+            if content_state['count']:
+                # resuming, the last committed id replaces the offset
+                offset = None
+                if limit is not None:
+                    limit = max(0, limit - content_state['count'])
+            pool = Pool(self.workers) if self.workers > 1 else None
+            self._read_content(mysql_cnx, [], limit, offset, pool)
+            if pool:
+                pool.close()
+                pool.join()
+        article_count = content_state['count']
+        if self.rewrite_links:
+            print "-> {} enlaces internos reescritos".format(content_state.get('links', 0))
+        if content_state.get('orphan_users'):
+            print "-> {} Articulos de usuarios inexistentes quedaron sin usuario".format(content_state['orphan_users'])
+        if content_state.get('orphan_categorizations'):
+            print "-> {} Articulos de categorias inexistentes quedaron sin categorizar".format(content_state['orphan_categorizations'])
         # a counter to know in which proportion are we retrieving html images
-        error_counter = 0
+        error_counter = content_state['errors']
+        img_success_percent = 100 - (error_counter * 100 / article_count) if article_count else 100
+        return article_count, img_success_percent
+
+    def _read_content(self, mysql_cnx, where, limit, offset, pool):
+        """migrates the content rows matching where, after the last one recorded in the checkpoint."""
+        content_state = self._checkpoint['content']
         fields = ('id', 'title', 'alias', 'introtext', 'fulltext', 'created', 'modified', 'state', 'catid', 'created_by', 'images')
-        # we need to quote field names because fulltext is a reserved mysql keyword
-        quoted_fields = ["`{}`".format(field) for field in fields]
-        query = "SELECT {} FROM {}content".format(quoted_fields, self.table_prefix)
-        query = self._clean_list(query)
-        query = self._limit_query(query, nlimit, offset)
-        cursor = mysql_cnx.cursor()
-        cursor.execute(query)
-        for content_hash in cursor:
+        # rows ordered by id starting after the last committed one,
+        # unlike an offset it doesn't make MySQL read and discard the preceding rows
+        if content_state['last_id']:
+            where = [('id', '>', content_state['last_id'])] + where
+        images_spool = self._open_images_spool(content_state['images_offset'])
+        cursor = mysql_cnx.select('content', fields, where, order_by='id', limit=limit, offset=offset, unbuffered=True)
+        convert = lambda content_hashes: self._convert_content_batch(content_hashes, pool)
+        write = lambda batch: self._write_content_batch(batch, images_spool)
+        if self.pipeline:
+            self._pipeline(self._cursor_batches(cursor), convert, write)
+        else:
+            for content_hashes in self._cursor_batches(cursor):
+                write(convert(content_hashes))
+        cursor.close()
+        images_spool.close()
+
+    def _fetch_content_shards(self, mysql_cnx, limit, offset):
+        """Splits content in ranges of ids with about the same number of rows, from a scan of its ids,
+           and forks a process migrating each one. The ranges are kept in the checkpoint, so a resumed
+           migration continues each shard where it was left. Once all of them finish, their counts and
+           spooled images are merged, in order of ids, into the content state."""
+        content_state = self._checkpoint['content']
+        if not content_state.get('shards'):
+            start = int(offset or 0)
+            count = max(0, mysql_cnx.count('content') - start)
+            if limit is not None:
+                count = min(count, limit)
+            content_state['shards'] = self._shard_ranges(mysql_cnx, start, count)
+            with self._checkpoint_lock:
+                self._save_checkpoint()
+        print "-> {} shards de contenido".format(len(content_state['shards']))
+        # read once here instead of by each shard
+        self._registered(User)
+        self._registered(Category)
+        # a connection can't be shared by processes, each shard opens its own
+        connection.close()
+        processes = []
+        for number, shard in enumerate(content_state['shards']):
+            process = Process(target=self._run_shard, args=(number, shard))
+            process.start()
+            processes.append(process)
+        failed = []
+        for number, process in enumerate(processes):
+            process.join()
+            if process.exitcode:
+                failed.append(number)
+        if failed:
+            raise CommandError("Content shards {} failed, run again with --resume to continue them.".format(failed))
+        self._merge_shards(content_state)
+        # articles were registered by the shards
+        with self._registry_lock:
+            self._registry.pop(Article.__name__, None)
+
+    def _shard_ranges(self, cnx, start, count):
+        """Ranges of about the same number of ids, for the count rows after the first start ones.
+           Each one starts after its last_id and ends before its before. Content ids are streamed
+           in order, only the last one before each range is kept."""
+        size = max(1, -(-count // self.shards))
+        cursor = cnx.select('content', ('id',), order_by='id', limit=start + count, unbuffered=True)
+        # ids skipped by the offset are before the first range
+        afters = []
+        last_id = 0
+        for position, row in enumerate(cursor):
+            if position >= start and (position - start) % size == 0:
+                afters.append(last_id)
+            last_id = row['id']
+        cursor.close()
+        shards = []
+        for number, after in enumerate(afters):
+            state = self._new_content_state()
+            state['last_id'] = after
+            state['before'] = (afters[number + 1] if number + 1 < len(afters) else last_id) + 1
+            shards.append(state)
+        return shards
+
+    def _run_shard(self, number, shard):
+        """Runs in a forked process, migrating the ids of a shard with its own connections, and with --workers its own pool.
+           Its progress is recorded in its own state file and images spool.
+           Locks are created again, the fork may have copied them while another phase's thread held them."""
+        self._checkpoint_lock = threading.RLock()
+        self._registry_lock = threading.Lock()
+        self._committed_content = None
+        self._state_name = 'shard{}.json'.format(number)
+        self._spool_name = 'images.shard{}.jsonl'.format(number)
+        state_path = self._checkpoint_path(self._state_name)
+        if os.path.exists(state_path):
+            with open(state_path) as state_file:
+                self._checkpoint = json.load(state_file)
+        else:
+            self._checkpoint = {'content': dict(shard)}
+        counters = phase_counters.current = PhaseCounters()
+        cnx = self._open_source()
+        pool = Pool(self.workers) if self.workers > 1 else None
+        try:
+            self._read_content(cnx, [('id', '<', shard['before'])], None, None, pool)
+            self._checkpoint['counters'] = {'rows_read': counters.rows_read, 'rows_written': counters.rows_written,
+                                            'queries': counters.queries + len(connection.queries)}
+            self._save_checkpoint()
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            cnx.close()
+            connection.close()
+
+    def _merge_shards(self, content_state):
+        """adds up the shards states into content_state, and concatenates their spools into the images spool."""
+        images_spool = self._open_images_spool(0)
+        counters = current_counters()
+        shard_paths = []
+        for number in xrange(len(content_state['shards'])):
+            state_path = self._checkpoint_path('shard{}.json'.format(number))
+            spool_path = self._checkpoint_path('images.shard{}.jsonl'.format(number))
+            with open(state_path) as state_file:
+                shard_checkpoint = json.load(state_file)
+            shard_state = shard_checkpoint['content']
+            for key in ('count', 'errors', 'links', 'categorizations', 'orphan_users', 'orphan_categorizations'):
+                content_state[key] += shard_state[key]
+            content_state['last_id'] = max(content_state['last_id'], shard_state['last_id'])
+            with open(spool_path, 'rb') as shard_spool:
+                pending = shard_state['images_offset']
+                while pending:
+                    chunk = shard_spool.read(min(pending, 1 << 20))
+                    images_spool.write(chunk)
+                    pending -= len(chunk)
+            shard_counters = shard_checkpoint['counters']
+            counters.rows_read += shard_counters['rows_read']
+            counters.rows_written.update(shard_counters['rows_written'])
+            counters.queries += shard_counters['queries']
+            shard_paths.extend([state_path, spool_path])
+        content_state['images_offset'] = images_spool.tell()
+        images_spool.close()
+        del content_state['shards']
+        with self._checkpoint_lock:
+            self._save_checkpoint()
+        for path in shard_paths:
+            os.remove(path)
+
+    def _convert_content_batch(self, content_hashes, pool=None):
+        """Articles, their categorizations and images from a batch of content rows,
+           with the last id and how many contents couldn't be parsed for the checkpoint.
+           Links to Joomla pages found while parsing are rewritten with --rewrite-links.
+           Articles of users that weren't migrated are left without user, and categorizations
+           to categories that weren't migrated are dropped, instead of failing as IntegrityErrors."""
+        articles = []
+        articles_categorizations = []
+        articles_images = []
+        rewritten = 0
+        orphan_users = orphan_categorizations = 0
+        users = self._registered(User)
+        categories = self._registered(Category)
+        html_images, html_links, error_counter = self._parse_html_batch(content_hashes, 0, pool)
+        for content_hash, related_images, links in zip(content_hashes, html_images, html_links):
             article = self._content_to_article(content_hash)
+            if links and self.rewrite_links:
+                article.text, count = self._rewrite_links(article.text, links)
+                rewritten += count
+            if article.user_id not in users:
+                # 0 is no user in Joomla
+                if article.user_id:
+                    orphan_users += 1
+                article.user_id = None
             articles.append(article)
             # this is here to have a single query to the largest table
-            articles_categorizations.append( self._categorize_object(article.pk, content_hash['catid'], self._article_content_type) )
-            articles_images.append( self._content_to_images(content_hash, article.pk) )
-            related_images, error_counter = self._parse_html_images(content_hash, article.pk, error_counter)
-            articles_images.append(related_images)
-        cursor.close()
-        Article.objects.bulk_create(articles)
-        article_count = Article.objects.count()
-        img_success_percent = 100 - (error_counter * 100 / article_count)
-        return article_count, articles_images, articles_categorizations, img_success_percent
+            if content_hash['catid'] in categories:
+                articles_categorizations.append( self._categorize_object(article.pk, content_hash['catid'], self._article_content_type) )
+            else:
+                orphan_categorizations += 1
+            images = self._content_to_images(content_hash, article.pk)
+            if images:
+                articles_images.append(images)
+            if related_images:
+                articles_images.append(related_images)
+        return {
+            'articles': articles,
+            'categorizations': articles_categorizations,
+            'images': articles_images,
+            'last_id': content_hashes[-1]['id'],
+            'count': len(content_hashes),
+            'errors': error_counter,
+            'links': rewritten,
+            'orphan_users': orphan_users,
+            'orphan_categorizations': orphan_categorizations,
+        }
+
+    def _write_content_batch(self, batch, images_spool):
+        """saves a converted batch, spools its images and records it in the checkpoint."""
+        self._save_content_batch(batch['articles'], batch['categorizations'])
+        for images in batch['images']:
+            images_spool.write(json.dumps(images) + '\n')
+        images_spool.flush()
+        with self._checkpoint_lock:
+            content_state = self._checkpoint['content']
+            content_state['last_id'] = batch['last_id']
+            content_state['count'] += batch['count']
+            content_state['errors'] += batch['errors']
+            content_state['links'] = content_state.get('links', 0) + batch['links']
+            content_state['categorizations'] = content_state.get('categorizations', 0) + len(batch['categorizations'])
+            content_state['orphan_users'] = content_state.get('orphan_users', 0) + batch['orphan_users']
+            content_state['orphan_categorizations'] = content_state.get('orphan_categorizations', 0) + batch['orphan_categorizations']
+            content_state['images_offset'] = images_spool.tell()
+            self._save_checkpoint()
+
+    def _save_content_batch(self, articles, categorizations):
+        """Articles have to exist before their categorizations.
+           A batch is saved entirely or not at all, so it can be resumed from the last one.
+           With --fast-load batches are part of the phase transaction instead, unless a pipeline writes them."""
+        if self._content_atomic:
+            self._bulk_create(Article, articles)
+            self._bulk_create(Categorization, categorizations)
+            return
+        with transaction.commit_on_success():
+            self._bulk_create(Article, articles)
+            self._bulk_create(Categorization, categorizations)
 
     def _create_collections(self):
         """Creates Collections infering them from Categories extensions."""
@@ -265,216 +1581,489 @@ class Command(BaseCommand):
     def _fetch_categories(self, mysql_cnx):
         """Queries Joomla's categories table to populate Categories."""
         fields = ('id', 'path', 'title', 'alias', 'description', 'published', 'parent_id', 'lft', 'rgt', 'level', 'extension')
-        query = "SELECT {} FROM {}categories".format(fields, self.table_prefix)
-        query = self._clean_tuple(query)
         # we are considering only categories for the Contents collection.
-        query += " WHERE extension = 'com_content'"
-        cursor = mysql_cnx.cursor()
-        cursor.execute(query)
+        # in id order, repeated titles are renamed in the same order by --verify
+        cursor = mysql_cnx.select('categories', fields, [('extension', '=', 'com_content')], order_by='id')
         categories = []
         for category_hash in cursor:
             category = self._category_to_category(category_hash)
             if category:
                 categories.append(category)
         cursor.close()
-        try:
-            # save categorties in bulk so it doesn't call custom Category save, which doesn't allow custom ids
-            Category.objects.bulk_create(categories)
-        except IntegrityError:
-            # duplicate query is expensive, we try not to perform it if we can
-            categories = self._category_duplicates_uniqueness(mysql_cnx, categories)
-            Category.objects.bulk_create(categories)
-        Category.tree.rebuild()
-        category_count = Category.objects.filter(collection_id=self._categories_collection).count()
-        return category_count
-
-    def _category_duplicates_uniqueness(self, mysql_cnx, categories):
-        """find duplicate names, since AutoSlugField doesn't properly preserve uniqueness in bulk."""
-        cursor = mysql_cnx.cursor()
-        query = "SELECT id FROM {}categories WHERE title IN (SELECT title FROM {}categories GROUP BY title HAVING COUNT(title) > 1)".format(self.table_prefix, self.table_prefix)
-        cursor.execute(query) 
-        result = [x['id'] for x in cursor.fetchall()]
-        cursor.close()
-        duplicates = [cat for cat in categories if cat.id in result]
-        for dup in duplicates: categories.remove(dup)
-        # sort duplicate categories by name ignoring case
-        duplicates.sort(key = lambda cat: operator.attrgetter('name')(cat).lower(), reverse=False)
-        # categories can have the same name if they're different collections, but not the same slug
-        duplicates = self._dup_categories_slugs(duplicates)
-        # categories with the same collection cannot have the same name
-        duplicates = self._dup_categories_collections(duplicates)
-        categories += duplicates
-        return categories
+        parents = dict((category.pk, category.parent_id) for category in categories)
+        nested_set = self.nested_sets and self._nested_set_tree(categories, parents, 1)
+        self._unique_categories(categories)
+        # save categorties in bulk so it doesn't call custom Category save, which doesn't allow custom ids
+        self._bulk_create(Category, categories)
+        if not nested_set:
+            Category.tree.rebuild()
+        return len(categories)
+
+    def _unique_categories(self, categories):
+        """AutoSlugField doesn't keep slugs unique among objects created in bulk, so they're given here.
+           Categories can have the same name if they're in different collections, but not the same slug."""
+        for category in categories:
+            category.slug = self._unique_slug(Category, category.name)
+            category.name = self._unique_category_name(category.collection_id, category.name)
 
     def _fetch_min_id(self, mysql_cnx):
         """we need this datum so that categories and tags ids don't collide"""
-        cursor = mysql_cnx.cursor()
-        query = "select max(id) as min_id from {}categories".format(self.table_prefix)
-        cursor.execute(query)
-        min_id = cursor.fetchone()['min_id']
-        return min_id
+        return mysql_cnx.max('categories', 'id') or 0
 
     def _fetch_categories_from_tags(self, mysql_cnx, min_id):
         """Migrate Joomla's Tags as Cyclopes Categories in a separate Collection.
            Table content_item_tags_map is the equivalent of Categorizations."""
         fields = ('id', 'parent_id', 'lft', 'rgt', 'level', 'title', 'published') # note, description, urls, path, alias, created_time
-        query = "SELECT {} FROM {}tags".format(fields, self.table_prefix)
-        query = self._clean_tuple(query)
-        cursor = mysql_cnx.cursor()
-        cursor.execute(query)
+        cursor = mysql_cnx.select('tags', fields, order_by='id')
         categories = []
         for tag_hash in cursor:
             category = self._tag_to_category(tag_hash, min_id)
-            categories.append(category)
+            if category:
+                categories.append(category)
         cursor.close()
-        Category.objects.bulk_create(categories)
-        Category.tree.rebuild()
-        tag_count = Category.objects.filter(collection_id=self._tags_collection).count()
-        return tag_count
+        parents = dict((category.pk, category.parent_id) for category in categories)
+        # tags trees come after categories trees
+        first_tree_id = (Category.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0) + 1
+        nested_set = self.nested_sets and self._nested_set_tree(categories, parents, first_tree_id)
+        self._unique_categories(categories)
+        self._bulk_create(Category, categories)
+        if not nested_set:
+            Category.tree.rebuild()
+        return len(categories)
 
     def _fetch_categorizations_from_tag_map(self, mysql_cnx, min_id):
+        """With --pipeline the tag map is read, converted and written in batches at the same time,
+           each batch is committed on its own. Returns the categorizations created."""
         fields = ('type_alias', 'content_item_id', 'tag_id') # core_content_id (PK?), type_id (==type_alias), tag_date
-        query = "SELECT {} FROM {}contentitem_tag_map".format(fields, self.table_prefix)
-        query = self._clean_tuple(query)
-        cursor = mysql_cnx.cursor()
-        cursor.execute(query)
-        categorizations = []
-        for map_hash in cursor:
-            categorization = self._tag_map_to_categorization(map_hash, min_id)
-            categorizations.append(categorization)
-        cursor.close()
-        categorizations = [cat for cat in categorizations if cat] # clean nulls
-        categorization_count = self._mass_categorization(categorizations)
+        if self.pipeline:
+            # batches committed by a failed run are categorized again
+            Categorization.objects.filter(category__collection=self._tags_collection).delete()
+            cursor = mysql_cnx.select('contentitem_tag_map', fields, unbuffered=True)
+            sizes = []
+            def convert(map_hashes):
+                categorizations = self._tag_map_to_categorizations(map_hashes, min_id)
+                sizes.append(len(categorizations))
+                return categorizations
+            self._pipeline(self._cursor_batches(cursor), convert, self._save_categorizations_batch)
+            cursor.close()
+            categorization_count = sum(sizes)
+        else:
+            cursor = mysql_cnx.select('contentitem_tag_map', fields)
+            categorizations = self._tag_map_to_categorizations(cursor, min_id)
+            cursor.close()
+            self._bulk_create(Categorization, categorizations)
+            categorization_count = len(categorizations)
+        if self._orphans['tag_map']:
+            print "-> {} Tags de articulos o tags inexistentes descartados".format(self._orphans['tag_map'])
         return categorization_count
 
-    def _create_images(self, images):
-        """ massive picture creation """
-        pictures = []
-        for image in images:
-            if not image:
+    def _tag_map_to_categorizations(self, map_hashes, min_id):
+        """categorizations of articles, except those of a tag or an article that weren't migrated, which are counted."""
+        categories = self._registered(Category)
+        articles = self._registered(Article)
+        categorizations = []
+        for map_hash in map_hashes:
+            categorization = self._tag_map_to_categorization(map_hash, min_id)
+            if not categorization:
                 continue
+            if categorization.category_id in categories and categorization.object_id in articles:
+                categorizations.append(categorization)
             else:
-                image_hash = image[0]
-            picture = self._image_to_picture(image_hash)
-            picture.description = self._pic_info_to_description(image_hash['article_id'], image_hash['image_type'])
-            pictures.append(picture)
-        # clean duplicate slugs
-        pictures = self._duplicate_pictures_removal(pictures)
-        # bulk insert
-        Picture.objects.bulk_create(pictures)
-        # retrieve relation from description
+                self._orphans['tag_map'] += 1
+        return categorizations
+
+    def _save_categorizations_batch(self, categorizations):
+        with transaction.commit_on_success():
+            self._bulk_create(Categorization, categorizations)
+
+    def _create_images(self, images, reuse_existing=False):
+        """ massive picture creation
+            each physical image, identified by its normalized src, becomes a single picture
+            related to every article using it. pictures are inserted batch_size at a time,
+            relations are created once their primary keys are known.
+            reuse_existing looks up pictures already in the database by src (i.e. syncing).
+            with --joomla-root image files are ingested into the media library as their pictures are saved."""
+        if self.joomla_root:
+            self._start_ingestion()
+        picture_ids = {} # src to primary key of saved pictures
+        pending = {} # src to pictures not saved yet
+        relations = []
+        last_article_id = None
+        pictures_count = related_count = 0
+        articles_with_images = set()
+        for image_list in images:
+            for image_hash in image_list:
+                src = self._normalize_src(image_hash['src'])
+                if not src:
+                    continue
+                # an article's images come together, we skip those it uses twice
+                relation = (src, image_hash['article_id'], image_hash['image_type'])
+                if image_hash['article_id'] != last_article_id:
+                    last_article_id = image_hash['article_id']
+                    article_relations = set()
+                if relation in article_relations:
+                    continue
+                article_relations.add(relation)
+                relations.append(relation)
+                if image_hash['image_type'] == 'article':
+                    articles_with_images.add(image_hash['article_id'])
+                else:
+                    related_count += 1
+                if src not in picture_ids and src not in pending:
+                    image_hash = dict(image_hash, src=src)
+                    pending[src] = self._image_to_picture(image_hash)
+                if len(pending) >= self.batch_size or len(relations) >= self.batch_size:
+                    pictures_count += self._save_pictures_batch(pending, picture_ids, reuse_existing)
+                    self._relate_pictures(relations, picture_ids)
+                    pending = {}
+                    relations = []
+        pictures_count += self._save_pictures_batch(pending, picture_ids, reuse_existing)
+        self._relate_pictures(relations, picture_ids)
+        if self.joomla_root:
+            self._finish_ingestion()
+        return pictures_count, related_count, len(articles_with_images)
+
+    def _save_pictures_batch(self, pending, picture_ids, reuse_existing=False):
+        """Saves pending pictures, when reusing existing ones only those without a picture for the same src.
+           bulk_create doesn't return primary keys, we look them up by slug and add them to picture_ids.
+           Returns how many pictures were created."""
+        if reuse_existing:
+            for srcs in self._split_large_inserts(pending.keys()):
+                # pictures keep Joomla's src unless their file was ingested
+                images = dict((src, src) for src in srcs)
+                if self.joomla_root:
+                    images.update((self._media_path(src), src) for src in srcs if not re.match('^[a-zA-Z]+://', src))
+                for image, picture_id in Picture.objects.filter(image__in=images.keys()).values_list('image', 'pk'):
+                    picture_ids[images[unicode(image)]] = picture_id
+        new_pictures = dict((src, picture) for src, picture in pending.items() if src not in picture_ids)
+        if not new_pictures:
+            return 0
+        if self.joomla_root:
+            self._ingest_pictures(new_pictures)
+        # pictures are named after their file, different paths can have the same file name
+        for picture in new_pictures.values():
+            picture.slug = self._unique_slug(Picture, picture.name)
+        self._bulk_create(Picture, new_pictures.values())
+        slug_srcs = dict((picture.slug, src) for src, picture in new_pictures.items())
+        for slugs in self._split_large_inserts(slug_srcs.keys()):
+            for slug, picture_id in Picture.objects.filter(slug__in=slugs).values_list('slug', 'pk'):
+                picture_ids[slug_srcs[slug]] = picture_id
+        return len(new_pictures)
+
+    def _relate_pictures(self, relations, picture_ids):
         pic_relations = []
-        for pic in Picture.objects.all():
-            article_id, image_type = self._pic_info_from_description(pic.description)
-            relation = {'picture_id': pic.pk, 'article_id': article_id, 'image_type': image_type}
+        for src, article_id, image_type in relations:
+            relation = {'picture_id': picture_ids[src], 'article_id': article_id, 'image_type': image_type}
             pic_relations.append(relation)
-        # pass relations to queries
         self._bulk_relate_images(pic_relations)
-        # clean descriptions
-        Picture.objects.all().update(description='')
-        return Picture.objects.count(), RelatedContent.objects.count(), Article.objects.exclude(pictures=None).count()
-
-    def _duplicate_pictures_removal(self, pictures):
-        """for bulk picture creation we treat here duplicate pictures slugs.
-           since we are using article id and img src for slugs, duplicate slugs are really duplicate pictures,
-           so we just remove them. there could be other strategies whenever it makes sense.
-           therefore we group pictures indexes by slug (there is no pk yet), 
-           removing all but the first of each group (original one).
-           """
-        # count slugs appearing more than once
-        duplicate_slugs = [slug for slug, count in Counter([pic.slug for pic in pictures]).items() if count > 1]
-        # find the index in this list for pictures with duplicate slugs, grouped by slug
-        slush = {}
-        slush = slush.fromkeys(duplicate_slugs)
-        for key in slush.iterkeys(): slush[key]=[]
-        for i, pic in enumerate(pictures):
-            if pic.slug in duplicate_slugs:
-                if slush[pic.slug]:
-                    pictures.pop(i)
-                else:
-                    slush[pic.slug].append(i)
-        return pictures
-
-    def _pic_info_to_description(self, article_id, image_type):
-        to_json = {'article_id': article_id, 'image_type': image_type}
-        return json.dumps(to_json)
-
-    def _pic_info_from_description(self, description):
-        info_hash = json.loads(description)
-        article_id = info_hash['article_id']
-        image_type = info_hash['image_type']
-        return article_id, image_type
-
-    def _mass_categorization(self, categorizations):
-        Categorization.objects.bulk_create(categorizations)
-        return Categorization.objects.count()
 
     def _fetch_menus(self, cnx):
         """migrate joomla menu_types to cyclope menus
            they have a similar tree algorithm so hierarchy is preserved."""
         fields = ('id', 'menutype', 'title', 'description')
-        query = "SELECT {} FROM {}menu_types".format(fields, self.table_prefix)
-        query = self._clean_tuple(query)
-        cursor = cnx.cursor()
-        cursor.execute(query)
+        cursor = cnx.select('menu_types', fields)
         menu_types = {}
         for menu_type_hash in cursor:
             menu = self._menu_type_to_menu(menu_type_hash)
             menu.save()
+            self._rows_written['Menu'] += 1
             menu_types[menu_type_hash['menutype']] = menu.pk
         cursor.close()
-        return Menu.objects.count(), menu_types
+        self._register(Menu, menu_types.values())
+        return len(menu_types), menu_types
 
     def _fetch_menuitems(self, cnx, menu_types):
         """migrate joomla menus to cyclope menuitems.
            they have a similar tree algorithm so hierarchy is preserved.
            menu_types is a dict mapping the FK to the menu_types menutype field."""
         fields = ('id', 'menutype', 'title', 'alias', 'path', 'link', 'published', 'parent_id', 'level', 'lft', 'rgt', 'home')
-        query = "SELECT {} FROM {}menu".format(fields, self.table_prefix)
-        query = self._clean_tuple(query)
-        cursor = cnx.cursor()
-        cursor.execute(query)
+        cursor = cnx.select('menu', fields)
         menuitems = []
+        parents = {}
         # delete pre existent menuitem 1 because of id collision
         MenuItem.objects.all().delete()
         for menu_hash in cursor:
             if menu_types.has_key(menu_hash['menutype']):
                 menuitem = self._menu_to_menuitem(menu_hash, menu_types)
                 menuitems.append(menuitem)
+                parents[menuitem.pk] = self._tree_hierarchy(menu_hash['parent_id'])
+        cursor.close()
+        nested_set = self.nested_sets and self._nested_set_tree(menuitems, parents, 1)
         # skip custom save method
-        MenuItem.objects.bulk_create(menuitems)
+        self._bulk_create(MenuItem, menuitems)
         # because of MenuItem's uniqueness constraint with parent, we can't associate parent_ids at bulk creation time
-        cursor.execute(query)
-        for menu_hash in cursor:
-            if menu_types.has_key(menu_hash['menutype']):
-                menuitem = self._menu_to_menuitem_tree(menu_hash)
-                menuitem.save()
-        cursor.close()
+        self._bulk_update_parents(MenuItem, dict((pk, parent_id) for pk, parent_id in parents.items() if parent_id))
         # resetear tree ids
-        MenuItem.tree.rebuild()
-        return MenuItem.objects.count()
+        if not nested_set:
+            MenuItem.tree.rebuild()
+        return len(menuitems)
 
     def _fetch_modules(self, cnx):
         """migrate joomla modules as cyclope external contents"""
         fields = ('id', 'title', 'note', 'content', 'published', 'publish_up')
         # mod_custom is the equivalent to HTMLBlock
-        query = "SELECT {} FROM {}modules".format(fields, self.table_prefix)
-        query = self._clean_tuple(query)
-        query += " WHERE module = 'mod_custom'"
-        cursor = cnx.cursor()
-        cursor.execute(query)
+        cursor = cnx.select('modules', fields, [('module', '=', 'mod_custom')])
         blocks = []
         for block_hash in cursor:
             block = self._module_to_html_block(block_hash)
             blocks.append(block)
-        HTMLBlock.objects.bulk_create(blocks)
-        return HTMLBlock.objects.count()
+        cursor.close()
+        self._bulk_create(HTMLBlock, blocks)
+        return len(blocks)
+
+    # PLANNING
+
+    def _plan(self, mysql_cnx):
+        """Estimates rows, memory and time of each phase with aggregate queries, without writing anything.
+           Content is sampled to estimate images and the cost of parsing its HTML."""
+        prefix = self.table_prefix
+        rows = {
+            'users': self._plan_count(mysql_cnx, "SELECT COUNT(*) AS n FROM {}users".format(prefix)),
+            'menus': self._plan_count(mysql_cnx, "SELECT COUNT(*) AS n FROM {}menu_types".format(prefix)),
+            'menuitems': self._plan_count(mysql_cnx, "SELECT COUNT(*) AS n FROM {0}menu WHERE menutype IN (SELECT menutype FROM {0}menu_types)".format(prefix)),
+            'categories': self._plan_count(mysql_cnx, "SELECT COUNT(*) AS n FROM {}categories WHERE extension = 'com_content'".format(prefix)),
+            'tags': self._plan_count(mysql_cnx, "SELECT COUNT(*) AS n FROM {}tags WHERE id > 1".format(prefix)),
+            'modules': self._plan_count(mysql_cnx, "SELECT COUNT(*) AS n FROM {}modules WHERE module = 'mod_custom'".format(prefix)),
+            'content': self._plan_count(mysql_cnx, "SELECT COUNT(*) AS n FROM {}content".format(prefix)),
+            'tag_map': self._plan_count(mysql_cnx, "SELECT COUNT(*) AS n FROM {}contentitem_tag_map WHERE type_alias LIKE 'com_content.article%'".format(prefix)),
+        }
+        duplicate_titles = self._plan_count(mysql_cnx, "SELECT COUNT(*) AS n FROM (SELECT title FROM {}categories WHERE extension = 'com_content' "
+                                                       "GROUP BY title HAVING COUNT(title) > 1) AS dups".format(prefix))
+        text_bytes = self._plan_count(mysql_cnx, "SELECT AVG(LENGTH(introtext) + LENGTH(`fulltext`)) AS n FROM {}content".format(prefix))
+        images_per_article, distinct_ratio, parse_seconds = self._plan_sample_content(mysql_cnx)
+        images = int(rows['content'] * images_per_article)
+        rows['images'] = int(images * distinct_ratio)
+
+        # memory held by each phase, most keep every row until their bulk insert
+        instance = self._plan_instance_bytes
+        memory = dict((phase, count * instance) for phase, count in rows.items())
+        memory['users'] = min(rows['users'], self.batch_size) * instance
+        memory['content'] = min(rows['content'], self.batch_size) * (instance + text_bytes * 2)
+        # the pictures index, and a batch of pictures
+        memory['images'] = rows['images'] * 200 + min(rows['images'], self.batch_size) * instance
+
+        seconds = dict((phase, count / float(self._plan_rows_per_second[phase])) for phase, count in rows.items())
+        seconds['users'] += self._plan_password_seconds(rows['users'])
+        seconds['content'] += rows['content'] * parse_seconds / self.workers
+        seconds['images'] = images / float(self._plan_rows_per_second['images'])
+
+        phases = ('users', 'menus', 'menuitems', 'categories', 'tags', 'modules', 'content', 'tag_map', 'images')
+        row = "{:<12} {:>10} {:>12} {:>12}"
+        print row.format('fase', 'filas', 'memoria MB', 'segundos')
+        for phase in phases:
+            print row.format(phase, rows[phase], "%.1f" % (memory[phase] / 1048576.0), "%.1f" % seconds[phase])
+        print "-> total estimado: %.1f s, pico de memoria %.1f MB" % (sum(seconds.values()), max(memory.values()) / 1048576.0)
+        print "-> {} imagenes en articulos, ~{} archivos distintos".format(images, rows['images'])
+        if duplicate_titles:
+            print "-> {} titulos de categorias repetidos, se renombraran como 'Titulo (2)'".format(duplicate_titles)
+        return rows, memory, seconds
+
+    def _plan_count(self, mysql_cnx, query):
+        cursor = mysql_cnx.cursor()
+        cursor.execute(query)
+        count = cursor.fetchone()['n']
+        cursor.close()
+        return int(count or 0)
 
-    # HELPERS
+    def _plan_sample_content(self, mysql_cnx):
+        """Reads up to _plan_sample_size articles spread along the id range, through primary key lookups.
+           Returns images per article, the ratio of distinct images, and HTML parsing seconds per article."""
+        cursor = mysql_cnx.cursor()
+        cursor.execute("SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM {}content".format(self.table_prefix))
+        bounds = cursor.fetchone()
+        if bounds['min_id'] is None:
+            cursor.close()
+            return 0, 1, 0
+        fields = ('id', 'introtext', 'fulltext', 'images')
+        quoted_fields = ["`{}`".format(field) for field in fields]
+        query = "SELECT {} FROM {}content WHERE id >= %s ORDER BY id LIMIT 1".format(quoted_fields, self.table_prefix)
+        query = self._clean_list(query)
+        step = max(1, (bounds['max_id'] - bounds['min_id']) / self._plan_sample_size)
+        images = []
+        parse_seconds = 0
+        sampled = set()
+        for sample_id in xrange(bounds['min_id'], bounds['max_id'] + 1, step):
+            cursor.execute(query, (sample_id,))
+            content_hash = cursor.fetchone()
+            if not content_hash or content_hash['id'] in sampled:
+                continue
+            sampled.add(content_hash['id'])
+            images += self._content_to_images(content_hash, content_hash['id'])
+            parse_start = time.time()
+            related_images, links, error_counter = self._parse_html(content_hash, content_hash['id'], 0)
+            parse_seconds += time.time() - parse_start
+            images += related_images
+        cursor.close()
+        srcs = [self._normalize_src(image['src']) for image in images]
+        srcs = [src for src in srcs if src]
+        distinct_ratio = len(set(srcs)) / float(len(srcs)) if srcs else 1
+        return len(srcs) / float(len(sampled)), distinct_ratio, parse_seconds / len(sampled)
+
+    def _plan_password_seconds(self, users):
+        """time one hash, unless every user shares the default password or has none."""
+        if self.unusable_passwords or self.joomla_password:
+            return 0
+        hash_start = time.time()
+        make_password('joomla2cyclope')
+        return (time.time() - hash_start) * users / self.workers
+
+    # INCREMENTAL SYNC
+
+    def _sync(self, mysql_cnx, since, start):
+        """Upserts Joomla rows modified after since into an already migrated site, nothing is deleted first.
+           Categories and Tags trees are rebuilt, and changed articles get their categorizations and images replaced.
+           Rows deleted in Joomla are not detected."""
+        print "syncing changes since {}...".format(since)
+        watermark = self._load_watermark(required=False)
+        min_id = watermark['min_tag_id'] if watermark else self._fetch_min_id(mysql_cnx)
+        self._sync_min_id = min_id
+
+        with self._measure('categories'), transaction.commit_on_success():
+            created, updated = self._sync_categories(mysql_cnx, since, min_id)
+        print "-> {} Categorias nuevas, {} actualizadas".format(created, updated)
+        with self._measure('tags'), transaction.commit_on_success():
+            created, updated = self._sync_tags(mysql_cnx, since, min_id)
+        print "-> {} Tags nuevos, {} actualizados".format(created, updated)
+        self._time_from(start)
+
+        with self._measure('content'):
+            created, updated, articles_images = self._sync_content(mysql_cnx, since)
+        print "-> {} Articulos nuevos, {} actualizados".format(created, updated)
+        self._time_from(start)
 
-    def _clean_tuple(self, query):
-        """clean tuple and quotes syntax"""
-        return re.sub("[\(\)']", '', query)
+        with self._measure('tag_map'), transaction.commit_on_success():
+            tagged_count = self._sync_tag_map(mysql_cnx, since, min_id)
+        print "-> {} Articulos con tags actualizados".format(tagged_count)
+
+        with self._measure('images'), transaction.commit_on_success():
+            images_count, related_count, article_images_count = self._create_images(articles_images, reuse_existing=True)
+        print "-> {} Imagenes migradas".format(images_count)
+        self._time_from(start)
+
+    def _sync_categories(self, mysql_cnx, since, min_id):
+        fields = ('id', 'path', 'title', 'alias', 'description', 'published', 'parent_id', 'lft', 'rgt', 'level', 'extension')
+        cursor = mysql_cnx.select('categories', fields, [('extension', '=', 'com_content'), ('modified_time', '>', since)], order_by='id')
+        categories = []
+        for category_hash in cursor:
+            # tags ids were shifted by the greatest category id at migration time
+            if category_hash['id'] > min_id:
+                print "categoria {} colisiona con los ids de tags, requiere una migracion completa".format(category_hash['id'])
+                continue
+            category = self._category_to_category(category_hash)
+            if category:
+                categories.append(category)
+        cursor.close()
+        # names and slugs were made unique when migrated, they're kept
+        counts = self._upsert(Category, categories, ('active', 'parent_id'), self._unique_categories)
+        Category.tree.rebuild()
+        return counts
+
+    def _sync_tags(self, mysql_cnx, since, min_id):
+        fields = ('id', 'parent_id', 'lft', 'rgt', 'level', 'title', 'published')
+        cursor = mysql_cnx.select('tags', fields, [('modified_time', '>', since)], order_by='id')
+        categories = [category for category in (self._tag_to_category(tag_hash, min_id) for tag_hash in cursor) if category]
+        cursor.close()
+        counts = self._upsert(Category, categories, ('active', 'parent_id'), self._unique_categories)
+        Category.tree.rebuild()
+        return counts
+
+    def _sync_content(self, mysql_cnx, since):
+        """Upserts articles created or modified after since in batches, replacing their categorizations.
+           Returns the images found in them, old ones are removed."""
+        articles_images = []
+        created = updated = 0
+        if self.rewrite_links:
+            self._load_link_index(mysql_cnx)
+        fields = ('id', 'title', 'alias', 'introtext', 'fulltext', 'created', 'modified', 'state', 'catid', 'created_by', 'images')
+        changed = [(None, 'OR', [('modified', '>', since), ('created', '>', since)])]
+        cursor = mysql_cnx.select('content', fields, changed, unbuffered=True)
+        pool = Pool(self.workers) if self.workers > 1 else None
+        article_fields = ('slug', 'name', 'modification_date', 'date', 'published', 'text', 'user_id')
+        for content_hashes in self._cursor_batches(cursor):
+            batch = self._convert_content_batch(content_hashes, pool)
+            articles_images.extend(batch['images'])
+            article_ids = [article.pk for article in batch['articles']]
+            with transaction.commit_on_success():
+                batch_created, batch_updated = self._upsert(Article, batch['articles'], article_fields)
+                self._replace_categorizations(article_ids, self._categories_collection, batch['categorizations'])
+                self._remove_articles_images(article_ids)
+            created += batch_created
+            updated += batch_updated
+        cursor.close()
+        if pool:
+            pool.close()
+            pool.join()
+        return created, updated, articles_images
+
+    def _sync_tag_map(self, mysql_cnx, since, min_id):
+        """Joomla updates tag_date when an item is tagged, for those items all their tag categorizations are replaced."""
+        cursor = mysql_cnx.select('contentitem_tag_map', ('content_item_id',), [('tag_date', '>', since), ('type_alias', '=', 'com_content.article')])
+        item_ids = sorted(set(row['content_item_id'] for row in cursor))
+        cursor.close()
+        if not item_ids:
+            return 0
+        fields = ('type_alias', 'content_item_id', 'tag_id')
+        cursor = mysql_cnx.select('contentitem_tag_map', fields, [('content_item_id', 'IN', set(item_ids))])
+        categorizations = self._tag_map_to_categorizations(cursor, min_id)
+        cursor.close()
+        self._replace_categorizations(item_ids, self._tags_collection, categorizations)
+        return len(item_ids)
+
+    def _upsert(self, model, objects, fields, prepare=None):
+        """Bulk creates objects that don't exist yet and updates the given fields of existing ones,
+           without calling custom save methods either way. prepare is called with the objects to create.
+           Returns created and updated counts."""
+        existing = set()
+        for ids in self._split_large_inserts([obj.pk for obj in objects]):
+            existing.update(model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        created = [obj for obj in objects if obj.pk not in existing]
+        if prepare:
+            prepare(created)
+        self._bulk_create(model, created)
+        self._register(model, existing)
+        for obj in objects:
+            if obj.pk in existing:
+                values = dict((field, getattr(obj, field)) for field in fields)
+                model.objects.filter(pk=obj.pk).update(**values)
+        self._rows_written[model.__name__] += len(existing)
+        return len(objects) - len(existing), len(existing)
+
+    def _replace_categorizations(self, article_ids, collection_id, categorizations):
+        """deletes articles categorizations in a collection and creates the given ones instead."""
+        for ids in self._split_large_inserts(article_ids):
+            Categorization.objects.filter(
+                content_type = self._article_content_type,
+                object_id__in = ids,
+                category__collection = collection_id
+            ).delete()
+        self._bulk_create(Categorization, categorizations)
+
+    def _remove_articles_images(self, article_ids):
+        """deletes the given articles relations to pictures, so they can be created again.
+           pictures may be shared with other articles, they are kept and reused by src."""
+        picture_type_id = ContentType.objects.get(name='picture').pk
+        article_pictures = Article.pictures.through.objects
+        for ids in self._split_large_inserts(article_ids):
+            article_pictures.filter(article_id__in=ids).delete()
+            RelatedContent.objects.filter(self_type=self._article_content_type, self_id__in=ids, other_type=picture_type_id).delete()
+
+    def _load_watermark(self, required=True):
+        """the watermark is kept next to the checkpoint, which is discarded on each full migration."""
+        watermark_path = self._checkpoint_path('watermark.json')
+        if not os.path.exists(watermark_path):
+            if required:
+                raise CommandError("No previous migration found at {}, use --since instead.".format(self.checkpoint_dir))
+            return None
+        with open(watermark_path) as watermark_file:
+            return json.load(watermark_file)
+
+    def _save_watermark(self, since, min_tag_id):
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        with open(self._checkpoint_path('watermark.json'), 'w') as watermark_file:
+            json.dump({'since': since, 'min_tag_id': min_tag_id}, watermark_file)
+
+    # HELPERS
 
     def _clean_list(self, query):
         """clean list and quotes syntax"""
@@ -483,18 +2072,867 @@ class Command(BaseCommand):
     def _tuples_to_dict(self, fields, results):
         return dict(zip(fields, results))
 
+    def _parse_date(self, value):
+        """--since and watermark dates, compared with Joomla's datetimes"""
+        for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+            try:
+                return datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+        raise CommandError("Invalid date {}, use YYYY-MM-DD HH:MM:SS".format(value))
+
     def _time_from(self, start):
         now = time.time()
         ellapsed = now - start 
         print( "%.2f s" % ellapsed )
 
-    def _limit_query(self, query, nlimit, offset):
-        """Adds SQL Limit/Offset syntax to limit queries to return only nlimit rows starting from offset."""
-        if nlimit:
-            query +=  " LIMIT {}".format(nlimit)
-        if offset:
-            query += " OFFSET {}".format(offset)
-        return query
+    @property
+    def _rows_written(self):
+        """rows written by the phase running in this thread, by model"""
+        return current_counters().rows_written
+
+    def _bulk_create(self, model, objects):
+        """bulk_create counting rows written for metrics."""
+        model.objects.bulk_create(objects)
+        self._rows_written[model.__name__] += len(objects)
+        self._register(model, [obj.pk for obj in objects if obj.pk is not None])
+        self._count_queries()
+
+    def _registered(self, model):
+        """The ids of a model's rows in Cyclope, to check foreign keys against before writing instead of
+           querying for them. Read from the database once, and kept up to date by _bulk_create and _upsert."""
+        with self._registry_lock:
+            name = model.__name__
+            if name not in self._registry:
+                self._registry[name] = set(model.objects.values_list('pk', flat=True))
+            return self._registry[name]
+
+    def _unique_slug(self, model, value):
+        """a slug for value that no other row of model has, the slugs in the database are read once."""
+        with self._registry_lock:
+            name = model.__name__
+            if name not in self._slugs:
+                self._slugs[name] = UniqueValues(model.objects.values_list('slug', flat=True))
+            return self._slugs[name].unique(cached_slugify(value))
+
+    def _unique_category_name(self, collection_id, name):
+        """categories in the same collection can't have the same name, MySQL compares them ignoring case."""
+        with self._registry_lock:
+            if collection_id not in self._category_names:
+                names = Category.objects.filter(collection=collection_id).values_list('name', flat=True)
+                self._category_names[collection_id] = UniqueValues(names, u'{} ({})', lambda name: name.lower())
+            return self._category_names[collection_id].unique(name)
+
+    def _register(self, model, ids):
+        """adds ids to the registry, unless the model wasn't read yet and they will be read along with the rest."""
+        with self._registry_lock:
+            if model.__name__ in self._registry:
+                self._registry[model.__name__].update(ids)
+
+    # SCHEDULING
+
+    def _phase_tasks(self, min_tag_id, nlimit, offset):
+        """the function running each phase, given a Joomla source and the results of the phases it depends on."""
+        return {
+            'users': lambda cnx, results: self._run_phase('users', self._fetch_users, cnx),
+            'menus': lambda cnx, results: self._run_phase('menus', self._fetch_menus, cnx),
+            'menuitems': lambda cnx, results: self._run_phase('menuitems', self._fetch_menuitems, cnx, results['menus'][1]),
+            'collections': lambda cnx, results: self._run_phase('collections', self._create_collections),
+            'categories': lambda cnx, results: self._run_phase('categories', self._fetch_categories, cnx),
+            'tags': lambda cnx, results: self._run_phase('tags', self._fetch_categories_from_tags, cnx, min_tag_id),
+            'modules': lambda cnx, results: self._run_phase('modules', self._fetch_modules, cnx),
+            # content commits its own batches and records the last one in the checkpoint
+            'content': lambda cnx, results: self._run_phase('content', self._fetch_content, cnx, nlimit, offset, atomic=self._content_atomic),
+            'tag_map': lambda cnx, results: self._run_phase('tag_map', self._fetch_categorizations_from_tag_map, cnx, min_tag_id, atomic=not self.pipeline),
+            'images': lambda cnx, results: self._run_phase('images', self._create_images, self._spooled_images()),
+        }
+
+    def _phases_to_run(self):
+        """the phases and their dependencies, only those given with --phases and the ones they need.
+           Those needed have to be finished by a previous run, then they just return their recorded result."""
+        if not self.phases:
+            return self._phase_dependencies
+        dependencies = dict(self._phase_dependencies)
+        unknown = [name for name in self.phases if name not in dependencies]
+        if unknown:
+            raise CommandError("Unknown phases {}, they are {}.".format(', '.join(unknown), ', '.join(name for name, _ in self._phase_dependencies)))
+        needed = set()
+        names = list(self.phases)
+        while names:
+            name = names.pop()
+            if name not in needed:
+                needed.add(name)
+                names.extend(dependencies[name])
+        missing = [name for name, _ in self._phase_dependencies
+                   if name in needed and name not in self.phases and name not in self._checkpoint['phases']]
+        if missing:
+            raise CommandError("Phases {} must be finished first, run them before continuing with --resume.".format(', '.join(missing)))
+        return tuple(phase for phase in self._phase_dependencies if phase[0] in needed)
+
+    def _run_phases(self, tasks, cnx, open_source, phases):
+        """Runs each of phases once the phases it depends on are finished, up to parallel_phases at a time.
+           Concurrent phases run in their own threads, with a Joomla source from open_source
+           and their own Django connection. Returns the result and seconds taken by each phase.
+           After a failed phase no other is started, and its error is raised once running ones finish."""
+        results = {}
+        durations = {}
+        if self.parallel_phases <= 1:
+            for name, dependencies in phases:
+                phase_start = time.time()
+                results[name] = tasks[name](cnx, results)
+                durations[name] = time.time() - phase_start
+                print "-> fase {} terminada, %.2f s".format(name) % durations[name]
+            return results, durations
+
+        finished = Queue()
+        errors = []
+
+        def run(name):
+            phase_cnx = None
+            phase_start = time.time()
+            try:
+                phase_cnx = open_source()
+                results[name] = tasks[name](phase_cnx, results)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                durations[name] = time.time() - phase_start
+                if phase_cnx:
+                    phase_cnx.close()
+                connection.close()
+                finished.put(name)
+
+        pending = list(phases)
+        running = {}
+        while pending or running:
+            for name, dependencies in list(pending):
+                if errors or len(running) >= self.parallel_phases:
+                    break
+                if all(dependency in results for dependency in dependencies):
+                    pending.remove((name, dependencies))
+                    running[name] = threading.Thread(target=run, args=(name,))
+                    running[name].start()
+            if not running:
+                break
+            name = finished.get()
+            running.pop(name).join()
+            if name in results:
+                print "-> fase {} terminada, %.2f s".format(name) % durations[name]
+        if errors:
+            exc_type, exc_value, traceback = errors[0]
+            raise exc_type, exc_value, traceback
+        return results, durations
+
+    def _critical_path(self, durations):
+        """the chain of dependent phases taking the longest, which bounds the migration time
+           however many phases run at the same time. Returns its phases and seconds."""
+        finish = {}
+        previous = {}
+        for name, dependencies in self._phase_dependencies:
+            before = max(dependencies, key=lambda dependency: finish[dependency]) if dependencies else None
+            previous[name] = before
+            finish[name] = durations.get(name, 0) + (finish[before] if before else 0)
+        last = max(finish, key=finish.get)
+        path = []
+        while last:
+            path.insert(0, last)
+            last = previous[last]
+        return path, finish[path[-1]]
+
+    def _print_critical_path(self, durations):
+        path, seconds = self._critical_path(durations)
+        print "-> camino critico: {}, %.2f s".format(' -> '.join(path)) % seconds
+        if self.metrics is not None:
+            self.metrics['critical_path'] = {'phases': path, 'seconds': seconds}
+
+    # PIPELINE
+
+    def _pipeline(self, batches, convert, write):
+        """Overlaps reading Joomla, converting and writing to Cyclope. A reader thread puts the batches
+           of the batches iterable in a queue, this thread converts them (and its pool parses them),
+           and a writer thread writes them in order, with its own database connection.
+           Queues are bounded, so memory stays the same whichever side is slower.
+           The first error stops the three of them, and is raised once they're done."""
+        read_queue = Queue(self._pipeline_depth)
+        write_queue = Queue(self._pipeline_depth)
+        stop = threading.Event()
+        errors = []
+        counters = current_counters()
+
+        def reader():
+            phase_counters.current = counters
+            try:
+                for batch in batches:
+                    if stop.is_set():
+                        break
+                    read_queue.put(batch)
+            except Exception:
+                errors.append(sys.exc_info())
+            read_queue.put(None)
+
+        def writer():
+            phase_counters.current = counters
+            if self.metrics is not None:
+                connection.use_debug_cursor = True
+            try:
+                for batch in iter(write_queue.get, None):
+                    write(batch)
+            except Exception:
+                errors.append(sys.exc_info())
+                stop.set()
+                # don't leave the converting thread waiting on a full queue
+                for batch in iter(write_queue.get, None):
+                    pass
+            finally:
+                counters.queries += len(connection.queries)
+                # Django opened a connection for this thread
+                connection.close()
+
+        threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for batch in iter(read_queue.get, None):
+                if not stop.is_set():
+                    write_queue.put(convert(batch))
+        except Exception:
+            errors.append(sys.exc_info())
+            stop.set()
+            for batch in iter(read_queue.get, None):
+                pass
+        write_queue.put(None)
+        for thread in threads:
+            thread.join()
+        if errors:
+            exc_type, exc_value, traceback = errors[0]
+            raise exc_type, exc_value, traceback
+        # this connection may be in a transaction started before the writer's commits, which it wouldn't see
+        transaction.commit_unless_managed()
+
+    def _cursor_batches(self, cursor, size=None):
+        """generator of the rows of a cursor, batch_size at a time."""
+        while True:
+            rows = cursor.fetchmany(size or self.batch_size)
+            if not rows:
+                break
+            yield rows
+
+    # METRICS
+
+    @contextmanager
+    def _measure(self, name):
+        """collects wall and CPU time, rows read and written, queries and peak memory of a phase, for --metrics-out."""
+        counters = phase_counters.current = PhaseCounters()
+        if self.metrics is None:
+            yield
+            return
+        # phases may run in their own threads, with their own connection
+        connection.use_debug_cursor = True
+        reset_queries()
+        start = time.time()
+        start_times = os.times()
+        yield
+        end_times = os.times()
+        self.metrics['phases'].append({
+            'phase': name,
+            'wall_time': time.time() - start,
+            'cpu_time': end_times[0] + end_times[1] - start_times[0] - start_times[1],
+            # worker processes
+            'children_cpu_time': end_times[2] + end_times[3] - start_times[2] - start_times[3],
+            'rows_read': counters.rows_read,
+            'rows_written': dict(counters.rows_written),
+            # pipeline writers log their queries in their own connection
+            'queries': len(connection.queries) + counters.queries,
+            # ru_maxrss is in kilobytes on linux, it's the peak since the migration started
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        })
+        # the query log would grow with the whole migration
+        reset_queries()
+
+    def _count_queries(self):
+        """Adds the queries logged by this thread's connection to the phase counters, and empties the log.
+           Called after each batch is written, the log would keep the SQL of every insert until the phase ends."""
+        if self.metrics is not None:
+            current_counters().queries += len(connection.queries)
+            reset_queries()
+
+    def _write_metrics(self, path, start):
+        if self.metrics is None:
+            return
+        self.metrics['wall_time'] = time.time() - start
+        with open(path, 'w') as metrics_file:
+            json.dump(self.metrics, metrics_file, indent=2)
+        print "metrics written to {}".format(path)
+
+    # VERIFICATION
+
+    def _verify(self, cnx):
+        """Streams Joomla's rows and the migrated ones side by side in primary key order, read batch_size at a time,
+           comparing a hash of the fields each row is mapped to. Articles text is left out, it's rewritten while migrating.
+           Joomla's users, categories and tags ids are kept to expect what the migration does with rows pointing to missing ones."""
+        print "verifying migration..."
+        start = time.time()
+        watermark = self._load_watermark(required=False)
+        min_id = watermark['min_tag_id'] if watermark else self._fetch_min_id(cnx)
+        joomla_ids = {}
+
+        def convert(kind, method, *args):
+            def converted(row):
+                obj = method(row, *args)
+                if obj is not None:
+                    joomla_ids.setdefault(kind, set()).add(obj.pk)
+                return obj
+            return converted
+
+        def unique_names(method):
+            # the migration renames repeated titles in a collection, in id order, see _unique_categories
+            names = UniqueValues(template=u'{} ({})', normalize=lambda name: name.lower())
+            def named(row, *args):
+                category = method(row, *args)
+                if category is not None:
+                    category.name = names.unique(category.name)
+                return category
+            return named
+
+        def menuitem(row):
+            if row['menutype'] not in menu_types:
+                return None
+            menuitem = self._menu_to_menuitem(row, menu_types)
+            # parents are updated after menu items are created
+            menuitem.parent_id = self._tree_hierarchy(row['parent_id'])
+            return menuitem
+
+        user_fields = ('username', 'first_name', 'email')
+        category_fields = ('name', 'active', 'parent_id', 'collection_id')
+        cyclope_category_fields = ('name', 'active', 'parent', 'collection')
+        menuitem_fields = ('menu_id', 'name', 'url', 'active', 'site_home')
+        article_fields = ('slug', 'name', 'date', 'published', 'user_id')
+        cursor = cnx.select('menu_types', ('id', 'menutype'))
+        menu_types = dict((row['menutype'], row['id']) for row in cursor)
+        cursor.close()
+        categories = Category.objects.all()
+        differences = []
+
+        differences.append(self._verify_rows('users',
+            self._joomla_rows(cnx, 'users', ('id', 'username', 'name', 'email', 'registerDate', 'lastvisitDate'), (),
+                              convert('users', self._user_to_user), user_fields),
+            # users of the Cyclope install, like its admin, aren't differences
+            self._cyclope_rows(User.objects.all(), user_fields), count_extra=False))
+        differences.append(self._verify_rows('categories',
+            self._joomla_rows(cnx, 'categories', ('id', 'title', 'published', 'parent_id', 'lft', 'rgt', 'level'), [('extension', '=', 'com_content')],
+                              convert('categories', unique_names(self._category_to_category)), category_fields),
+            self._cyclope_rows(categories.filter(collection=self._categories_collection), cyclope_category_fields)))
+        differences.append(self._verify_rows('tags',
+            self._joomla_rows(cnx, 'tags', ('id', 'parent_id', 'lft', 'rgt', 'level', 'title', 'published'), (),
+                              convert('tags', unique_names(self._tag_to_category), min_id), category_fields),
+            self._cyclope_rows(categories.filter(collection=self._tags_collection), cyclope_category_fields)))
+        differences.append(self._verify_rows('menuitems',
+            self._joomla_rows(cnx, 'menu', ('id', 'menutype', 'title', 'path', 'link', 'published', 'parent_id', 'level', 'lft', 'rgt', 'home'), (),
+                              menuitem, menuitem_fields + ('parent_id',)),
+            self._cyclope_rows(MenuItem.objects.all(), menuitem_fields + ('parent',))))
+
+        def article(row):
+            # text isn't compared
+            article = self._content_to_article(dict(row, introtext=u'', fulltext=None))
+            if article.user_id not in joomla_ids.get('users', ()):
+                article.user_id = None
+            return article
+        content_fields = ('id', 'title', 'alias', 'created', 'modified', 'state', 'created_by')
+        differences.append(self._verify_rows('articles',
+            self._joomla_rows(cnx, 'content', content_fields, (), article, article_fields),
+            self._cyclope_rows(Article.objects.all(), ('slug', 'name', 'date', 'published', 'user'))))
+        differences.append(self._verify_rows('categorizations',
+            self._joomla_categorizations(cnx, min_id, joomla_ids.get('categories', set()), joomla_ids.get('tags', set())),
+            self._cyclope_categorizations()))
+
+        self._time_from(start)
+        total = sum(differences)
+        if total:
+            raise CommandError("{} differences found between Joomla and Cyclope.".format(total))
+        print "-> migracion verificada, sin diferencias"
+
+    def _verify_rows(self, kind, joomla_rows, cyclope_rows, count_extra=True):
+        """merge join of two iterables of (primary key, hash) in ascending primary key order.
+           Prints the number of missing, extra and different rows, with a few of their ids. Returns how many were found,
+           extra rows are only reported unless count_extra."""
+        found = dict((difference, []) for difference in ('faltantes', 'sobrantes', 'distintos'))
+        counts = Counter()
+        joomla_row = next(joomla_rows, None)
+        cyclope_row = next(cyclope_rows, None)
+        while joomla_row is not None or cyclope_row is not None:
+            if cyclope_row is None or (joomla_row is not None and joomla_row[0] < cyclope_row[0]):
+                difference, pk = 'faltantes', joomla_row[0]
+                joomla_row = next(joomla_rows, None)
+            elif joomla_row is None or cyclope_row[0] < joomla_row[0]:
+                difference, pk = 'sobrantes', cyclope_row[0]
+                cyclope_row = next(cyclope_rows, None)
+            else:
+                difference, pk = 'distintos' if joomla_row[1] != cyclope_row[1] else None, joomla_row[0]
+                joomla_row = next(joomla_rows, None)
+                cyclope_row = next(cyclope_rows, None)
+                counts['rows'] += 1
+            if difference:
+                counts[difference] += 1
+                if len(found[difference]) < self._verify_report_ids:
+                    found[difference].append(pk)
+        print "-> {}: {} comparados, {} faltantes, {} sobrantes, {} distintos".format(
+            kind, counts['rows'], counts['faltantes'], counts['sobrantes'], counts['distintos'])
+        for difference, ids in sorted(found.items()):
+            if ids:
+                print "   {} {}: {}{}".format(kind, difference, ', '.join(str(pk) for pk in ids),
+                                             '...' if counts[difference] > len(ids) else '')
+        if self.metrics is not None:
+            self.metrics.setdefault('verify', {})[kind] = dict(counts, ids=found)
+        if not count_extra and counts['sobrantes']:
+            print "   {} sobrantes no cuentan como diferencias, son de Cyclope".format(kind)
+            return counts['faltantes'] + counts['distintos']
+        return counts['faltantes'] + counts['sobrantes'] + counts['distintos']
+
+    def _row_hash(self, values):
+        """the same values hash the same whichever database they were read from"""
+        normalized = []
+        for value in values:
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, datetime):
+                value = value.strftime('%Y-%m-%d %H:%M:%S')
+            normalized.append(None if value is None else unicode(value))
+        return hashlib.sha1(repr(normalized)).digest()
+
+    def _joomla_rows(self, cnx, table, fields, where, convert, model_fields):
+        """generator of the primary key and hash of the objects Joomla's rows are converted to, in primary key order."""
+        cursor = cnx.select(table, fields, where, order_by='id', unbuffered=True)
+        for row in cursor:
+            obj = convert(row)
+            if obj is not None:
+                yield obj.pk, self._row_hash(getattr(obj, field) for field in model_fields)
+        cursor.close()
+
+    def _cyclope_rows(self, queryset, fields):
+        """generator of the primary key and hash of fields of a queryset's rows, read in keyset batches."""
+        last_pk = None
+        while True:
+            batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            rows = list(batch.order_by('pk').values_list('pk', *fields)[:self.batch_size])
+            if not rows:
+                break
+            for row in rows:
+                yield row[0], self._row_hash(row[1:])
+            last_pk = rows[-1][0]
+
+    def _joomla_categorizations(self, cnx, min_id, categories, tags):
+        """generator of each article id and a hash of the categories it should have, from its category
+           and its tags, merged in id order. Categorizations to missing categories or tags are dropped while migrating,
+           as are tags of missing articles."""
+        content = cnx.select('content', ('id', 'catid'), order_by='id', unbuffered=True)
+        # an unbuffered cursor has to be read to the end before the connection runs another query
+        tag_cnx = self._open_source()
+        # articles have a single type_id, so the map's unique key orders them by content_item_id
+        tag_map = tag_cnx.select('contentitem_tag_map', ('content_item_id', 'tag_id'), [('type_alias', '=', 'com_content.article')],
+                             order_by=('type_id', 'content_item_id'), unbuffered=True)
+        # the category of an article comes before its tags, and tells the article exists
+        rows = heapq.merge(((row['id'], 0, row['catid']) for row in content),
+                           ((row['content_item_id'], 1, self._shift_min_id(row['tag_id'], min_id)) for row in tag_map))
+        for article_id, article_rows in groupby(rows, key=operator.itemgetter(0)):
+            article_rows = list(article_rows)
+            if article_rows[0][1] != 0:
+                continue
+            category_ids = [category_id for pk, source, category_id in article_rows
+                            if category_id in (categories if source == 0 else tags)]
+            if category_ids:
+                yield article_id, self._row_hash(sorted(category_ids))
+        content.close()
+        tag_map.close()
+        tag_cnx.close()
+
+    def _cyclope_categorizations(self):
+        """generator of each categorized article id and a hash of its categories, read a batch of articles at a time."""
+        categorizations = Categorization.objects.filter(content_type=self._article_content_type)
+        last_id = None
+        while True:
+            batch = categorizations if last_id is None else categorizations.filter(object_id__gt=last_id)
+            article_ids = list(batch.order_by('object_id').values_list('object_id', flat=True).distinct()[:self.batch_size])
+            if not article_ids:
+                break
+            rows = categorizations.filter(object_id__gte=article_ids[0], object_id__lte=article_ids[-1]).values_list('object_id', 'category_id')
+            for article_id, article_rows in groupby(sorted(rows), key=operator.itemgetter(0)):
+                yield article_id, self._row_hash(sorted(category_id for pk, category_id in article_rows))
+            last_id = article_ids[-1]
+
+    # STAGING
+
+    def _extract(self, cnx, path):
+        """Streams each table the migration reads, ordered by its key or its _staging_order, into path as chunks of
+           _staging_chunk_rows rows read by StagingSource. The index is written last, so an interrupted extraction can't be read."""
+        print "extracting Joomla's tables to {}...".format(path)
+        start = time.time()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        index = {'prefix': self.table_prefix, 'extracted': cnx.now(), 'tables': {}}
+        for table, columns, key in self._staging_tables:
+            name = self.table_prefix + table
+            chunks = []
+            cursor = cnx.select(table, columns, order_by=self._staging_order.get(table, key), unbuffered=True)
+            with open(os.path.join(path, name + '.chunks'), 'wb') as chunks_file:
+                for rows in self._cursor_batches(cursor, self._staging_chunk_rows):
+                    data = zlib.compress(pickle.dumps([tuple(row[column] for column in columns) for row in rows], pickle.HIGHEST_PROTOCOL))
+                    keys = [row[key] for row in rows]
+                    chunks.append((chunks_file.tell(), len(data), len(rows), min(keys), max(keys)))
+                    chunks_file.write(data)
+            cursor.close()
+            index['tables'][name] = {'columns': columns, 'key': key, 'chunks': chunks}
+            print "-> {} filas de {} extraidas".format(sum(chunk[2] for chunk in chunks), table)
+        index_path = os.path.join(path, 'index.json')
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+        os.rename(index_path + '.tmp', index_path)
+        self._time_from(start)
+
+    # CHECKPOINTS
+
+    def _load_checkpoint(self, resume, started):
+        """The checkpoint store is a directory with the state of each finished phase in a JSON file,
+           and the images found in contents spooled one JSON list per line, until the images phase uses them.
+           Unless resuming, a previous state is discarded."""
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        state_path = self._checkpoint_path(self._state_name)
+        if resume and os.path.exists(state_path):
+            with open(state_path) as state_file:
+                self._checkpoint = json.load(state_file)
+            print "resuming migration from {}...".format(self.checkpoint_dir)
+            if self._checkpoint['content'].get('shards'):
+                # shards commit each batch, even with --fast-load
+                self._content_atomic = False
+        else:
+            self._checkpoint = {
+                'started': started,
+                'phases': {},
+                'content': self._new_content_state(),
+            }
+            self._save_checkpoint()
+
+    def _new_content_state(self):
+        """where the content phase is, and what it found so far"""
+        return {'last_id': 0, 'count': 0, 'errors': 0, 'images_offset': 0, 'links': 0,
+                'categorizations': 0, 'orphan_users': 0, 'orphan_categorizations': 0}
+
+    def _save_checkpoint(self):
+        """the state is written to a temporary file and renamed, so a crash can't leave it half written.
+           phases running at the same time change it while holding _checkpoint_lock."""
+        with self._checkpoint_lock:
+            checkpoint = self._checkpoint
+            if self._committed_content is not None:
+                # the content phase hasn't committed yet
+                checkpoint = dict(checkpoint, content=self._committed_content)
+            state_path = self._checkpoint_path(self._state_name)
+            with open(state_path + '.tmp', 'w') as state_file:
+                json.dump(checkpoint, state_file)
+            os.rename(state_path + '.tmp', state_path)
+
+    def _checkpoint_path(self, name):
+        return os.path.join(self.checkpoint_dir, name)
+
+    def _run_phase(self, name, method, *args, **kwargs):
+        """Runs a migration phase unless it was finished by a resumed migration, returning its recorded result instead.
+           Phases run in a transaction so a failed one leaves nothing behind, except when atomic=False is given.
+           Content recorded by a phase in a transaction (--fast-load) is only written to disk once it commits,
+           a killed process mustn't leave a checkpoint ahead of the database. Only the content phase's own failure
+           rolls its state back, other phases may fail while it runs in another thread."""
+        phases = self._checkpoint['phases']
+        if name in phases:
+            print "-> fase {} ya completada".format(name)
+            return phases[name]
+        with self._measure(name):
+            if kwargs.get('atomic', True):
+                if name == 'content':
+                    content_state = self._committed_content = dict(self._checkpoint['content'])
+                try:
+                    with transaction.commit_on_success():
+                        result = method(*args)
+                except Exception:
+                    if name == 'content':
+                        with self._checkpoint_lock:
+                            self._committed_content = None
+                            if self._checkpoint['content'] != content_state:
+                                self._checkpoint['content'] = content_state
+                                self._save_checkpoint()
+                    raise
+            else:
+                result = method(*args)
+        with self._checkpoint_lock:
+            if name == 'content':
+                self._committed_content = None
+            phases[name] = result
+            self._save_checkpoint()
+        return result
+
+    def _open_images_spool(self, offset):
+        """opens the images spool to append images after offset,
+           anything after it belongs to a batch that wasn't recorded and will be read again."""
+        spool_path = self._checkpoint_path(self._spool_name)
+        spool = open(spool_path, 'r+b' if offset else 'wb')
+        spool.seek(offset)
+        spool.truncate()
+        return spool
+
+    def _spooled_images(self):
+        """generator of the image lists spooled by the content phase."""
+        content_state = self._checkpoint['content']
+        with open(self._checkpoint_path(self._spool_name), 'rb') as spool:
+            while spool.tell() < content_state['images_offset']:
+                yield json.loads(spool.readline())
+
+    # FAST LOAD
+
+    @contextmanager
+    def _fast_loading(self):
+        """With --fast-load, session settings are relaxed for every connection opened meanwhile,
+           and the secondary indexes of the largest tables are dropped, to be created again once loaded.
+           Both are restored even if the migration fails, integrity is checked only when it doesn't."""
+        if not self.fast_load:
+            yield
+            return
+        self._restore_deferred_indexes()
+        self._restore_settings = self._tune_connection(connection=connection)
+        connection_created.connect(self._tune_connection)
+        self._defer_indexes()
+        try:
+            yield
+        finally:
+            connection_created.disconnect(self._tune_connection)
+            self._restore_deferred_indexes()
+            if connection.connection is not None:
+                self._apply_settings(connection, self._restore_settings)
+        self._check_integrity()
+
+    def _tune_connection(self, sender=None, connection=None, **kwargs):
+        """applies the --fast-load settings to a connection, returning their previous values."""
+        tuning = self._fast_load_settings.get(connection.vendor, ())
+        cursor = connection.cursor()
+        previous = []
+        for name, value in tuning:
+            cursor.execute(self._setting_query(connection.vendor, name))
+            previous.append((name, unicode(cursor.fetchone()[0])))
+        cursor.close()
+        self._apply_settings(connection, tuning)
+        return previous
+
+    def _apply_settings(self, connection, tuning):
+        cursor = connection.cursor()
+        for name, value in tuning:
+            cursor.execute(self._setting_query(connection.vendor, name, value))
+        cursor.close()
+        # PostgreSQL's SET is undone if the transaction it's in is rolled back
+        connection.connection.commit()
+
+    def _setting_query(self, vendor, name, value=None):
+        """the query reading a session setting, or changing it when a value is given."""
+        if vendor == 'sqlite':
+            return 'PRAGMA {}'.format(name) if value is None else 'PRAGMA {} = {}'.format(name, value)
+        elif vendor == 'postgresql':
+            return 'SHOW {}'.format(name) if value is None else 'SET {} = {}'.format(name, value)
+        return 'SELECT @@session.{}'.format(name) if value is None else 'SET SESSION {} = {}'.format(name, value)
+
+    def _fast_load_tables(self):
+        """tables with most of the rows, whose secondary indexes are deferred"""
+        models = (Article, Categorization, Picture, RelatedContent, Article.pictures.through)
+        return [model._meta.db_table for model in models]
+
+    def _secondary_indexes(self, cursor, table):
+        """name and CREATE statement of a table's indexes that aren't unique nor needed by its foreign keys."""
+        vendor = connection.vendor
+        if vendor == 'sqlite':
+            # unique and primary key indexes created along with the table don't have sql
+            cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL", [table])
+            return [(name, sql) for name, sql in cursor.fetchall() if not sql.upper().startswith('CREATE UNIQUE')]
+        elif vendor == 'postgresql':
+            cursor.execute(
+                "SELECT i.relname, pg_get_indexdef(ix.indexrelid) FROM pg_index ix "
+                "JOIN pg_class i ON i.oid = ix.indexrelid JOIN pg_class t ON t.oid = ix.indrelid "
+                "WHERE t.relname = %s AND NOT ix.indisprimary AND NOT ix.indisunique", [table])
+            return list(cursor.fetchall())
+        elif vendor == 'mysql':
+            # InnoDB doesn't allow dropping the index of a foreign key, even without foreign_key_checks
+            cursor.execute(
+                "SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND REFERENCED_TABLE_NAME IS NOT NULL", [table])
+            foreign_keys = set(row[0] for row in cursor.fetchall())
+            cursor.execute(
+                "SELECT INDEX_NAME, COLUMN_NAME, SUB_PART FROM information_schema.STATISTICS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND NON_UNIQUE = 1 ORDER BY INDEX_NAME, SEQ_IN_INDEX", [table])
+            columns = {}
+            for name, column, sub_part in cursor.fetchall():
+                columns.setdefault(name, []).append((column, sub_part))
+            quote = connection.ops.quote_name
+            return [(name, 'CREATE INDEX {} ON {} ({})'.format(quote(name), quote(table), ', '.join(
+                        quote(column) + ('({})'.format(sub_part) if sub_part else '') for column, sub_part in index_columns)))
+                    for name, index_columns in columns.items() if not any(column in foreign_keys for column, sub_part in index_columns)]
+        return []
+
+    def _defer_indexes(self):
+        """drops secondary indexes, their statements are kept in the checkpoint directory
+           so they're created again by the next run if this one crashes before restoring them."""
+        cursor = connection.cursor()
+        indexes = []
+        for table in self._fast_load_tables():
+            indexes.extend([table, name, sql] for name, sql in self._secondary_indexes(cursor, table))
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        with open(self._checkpoint_path('deferred_indexes.json'), 'w') as indexes_file:
+            json.dump(indexes, indexes_file)
+        quote = connection.ops.quote_name
+        for table, name, sql in indexes:
+            if connection.vendor == 'mysql':
+                cursor.execute('DROP INDEX {} ON {}'.format(quote(name), quote(table)))
+            else:
+                cursor.execute('DROP INDEX {}'.format(quote(name)))
+        cursor.close()
+        transaction.commit_unless_managed()
+        print "-> {} indices secundarios diferidos".format(len(indexes))
+
+    def _restore_deferred_indexes(self):
+        indexes_path = self._checkpoint_path('deferred_indexes.json')
+        if not os.path.exists(indexes_path):
+            return
+        with open(indexes_path) as indexes_file:
+            indexes = json.load(indexes_file)
+        cursor = connection.cursor()
+        for table, name, sql in indexes:
+            cursor.execute(sql)
+        cursor.close()
+        transaction.commit_unless_managed()
+        os.remove(indexes_path)
+        print "-> {} indices secundarios creados".format(len(indexes))
+
+    def _check_integrity(self):
+        """Foreign keys weren't checked by MySQL, each one of the migrated models is checked for rows
+           pointing nowhere, and SQLite's file is checked after loading without a safe journal."""
+        cursor = connection.cursor()
+        problems = []
+        if connection.vendor == 'sqlite':
+            cursor.execute('PRAGMA quick_check')
+            problems.extend(row[0] for row in cursor.fetchall() if row[0] != 'ok')
+        quote = connection.ops.quote_name
+        models = (User, Menu, MenuItem, Category, Article, Categorization, HTMLBlock, Picture, RelatedContent, Article.pictures.through)
+        for model in models:
+            for field in model._meta.fields:
+                if not isinstance(field, ForeignKey):
+                    continue
+                target = field.rel.to._meta
+                cursor.execute(
+                    "SELECT COUNT(*) FROM {table} child LEFT JOIN {target} parent ON child.{column} = parent.{pk} "
+                    "WHERE child.{column} IS NOT NULL AND parent.{pk} IS NULL".format(
+                        table=quote(model._meta.db_table), target=quote(target.db_table),
+                        column=quote(field.column), pk=quote(target.pk.column)))
+                orphans = cursor.fetchone()[0]
+                if orphans:
+                    problems.append('{} {}.{} sin {}'.format(orphans, model._meta.db_table, field.column, target.db_table))
+        cursor.close()
+        if problems:
+            raise CommandError("Integrity check failed after --fast-load: {}".format('; '.join(problems)))
+        print "-> integridad verificada"
+
+    # MEDIA FILES
+
+    def _start_ingestion(self):
+        """Image files are read, hashed and copied by a pool of threads, it's I/O that releases the GIL,
+           while thumbnails are generated by worker processes in the background.
+           The checksums of ingested files are indexed in the checkpoint directory, a file with
+           the same contents as one already ingested (by this or a previous run) isn't copied again."""
+        # worker processes are forked before there are threads to copy
+        self._thumbnail_pool = Pool(self.workers) if Image and self._image_versions() else None
+        self._ingest_pool = ThreadPool(self._ingest_threads)
+        if Image is None:
+            print "PIL is not installed, thumbnails won't be generated"
+        self._ingest_lock = threading.Lock()
+        self._ingest_counts = Counter()
+        self._thumbnails = []
+        self._ingested = {}
+        index_path = self._checkpoint_path('ingested.tsv')
+        if os.path.exists(index_path):
+            with open(index_path) as index_file:
+                for line in index_file:
+                    checksum, path = line.rstrip('\n').split('\t', 1)
+                    self._ingested[checksum] = path.decode('utf-8')
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        self._ingest_index = open(index_path, 'a')
+
+    def _ingest_pictures(self, pictures):
+        """ingests the files of a batch of pictures, pointing them to their file in the media library.
+           pictures maps normalized srcs to pictures, those whose file isn't found keep their src."""
+        srcs = pictures.keys()
+        for src, path in zip(srcs, self._ingest_pool.map(self._ingest_file, srcs)):
+            if path:
+                pictures[src].image = path
+
+    def _ingest_file(self, src):
+        """hardlinks, clones or copies the file of src into MEDIA_ROOT, returns its path relative to it."""
+        if re.match('^[a-zA-Z]+://', src):
+            return None
+        root = os.path.abspath(self.joomla_root)
+        source = os.path.abspath(os.path.join(root, src))
+        if not source.startswith(root + os.sep) or not os.path.isfile(source):
+            with self._ingest_lock:
+                self._ingest_counts['missing'] += 1
+            return None
+        checksum = hashlib.sha1()
+        with open(source, 'rb') as source_file:
+            for chunk in iter(lambda: source_file.read(1 << 20), ''):
+                checksum.update(chunk)
+        checksum = checksum.hexdigest()
+        with self._ingest_lock:
+            if checksum in self._ingested:
+                self._ingest_counts['duplicated'] += 1
+                return self._ingested[checksum]
+        path = self._media_path(src)
+        target = os.path.join(self._media_root(), path)
+        if not os.path.isdir(os.path.dirname(target)):
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError:
+                # another thread made it
+                pass
+        if not os.path.exists(target):
+            try:
+                os.link(source, target)
+            except OSError:
+                # a different filesystem
+                clone_or_copy(source, target)
+        with self._ingest_lock:
+            self._ingested[checksum] = path
+            self._ingest_index.write(u'{}\t{}\n'.format(checksum, path).encode('utf-8'))
+            self._ingest_counts['ingested'] += 1
+            if self._thumbnail_pool:
+                self._thumbnails.append(self._thumbnail_pool.apply_async(image_versions, ((target, self._image_versions()),)))
+        return path
+
+    def _finish_ingestion(self):
+        self._ingest_pool.close()
+        self._ingest_pool.join()
+        self._ingest_index.close()
+        thumbnails = 0
+        if self._thumbnail_pool:
+            self._thumbnail_pool.close()
+            thumbnails = sum(result.get() for result in self._thumbnails)
+            self._thumbnail_pool.join()
+        counts = self._ingest_counts
+        print "-> {} archivos de imagenes copiados, {} repetidos, {} no encontrados".format(counts['ingested'], counts['duplicated'], counts['missing'])
+        print "-> {} miniaturas generadas".format(thumbnails)
+
+    def _media_path(self, src):
+        """Joomla's files keep their paths, under a joomla directory of filebrowser's uploads"""
+        directory = getattr(filebrowser_settings, 'DIRECTORY', 'uploads/')
+        return os.path.join(directory, 'joomla', src)
+
+    def _media_root(self):
+        return getattr(filebrowser_settings, 'MEDIA_ROOT', settings.MEDIA_ROOT)
+
+    def _image_versions(self):
+        return getattr(filebrowser_settings, 'VERSIONS', {})
 
     # CYCLOPE'S LOGIC
 
@@ -506,30 +2944,44 @@ class Command(BaseCommand):
         else:
             site.domain = "localhost:8000"
 
-    def _dup_categories_slugs(self, categories):
-        #use a counter to differentiate them
-        counter = 2
-        for idx, category in enumerate(categories):
-            if idx == 0 :
-                category.slug = slugify(category.name)
-            else:
-                if categories[idx-1].name.lower() == category.name.lower() :
-                    category.slug = slugify(category.name) + '-' + str(counter)
-                    counter += 1
-                else:
-                    counter = 2
-                    category.slug = slugify(category.name)
-        return categories
-
-    def _dup_categories_collections(self, categories):
-        counter = 1
-        for idx, category in enumerate(categories):
-            if idx != 0 :
-                if categories[idx-1].name.lower() == category.name.lower() :
-                    if categories[idx-1].collection == category.collection :
-                        category.name = category.name + " (" + str(counter) + ")"
-                else : counter = 1
-        return categories
+    def _nested_set_tree(self, nodes, parents, first_tree_id):
+        """Joomla keeps every node in a single nested set under a root node, while MPTT has a tree for each
+           top level node, with lft starting from 1 and level from 0. This maps Joomla's lft, rgt and level
+           of the nodes into MPTT fields in place, numbering trees from first_tree_id in Joomla's order,
+           so that the tree doesn't need to be rebuilt. parents maps node ids to their parent ids.
+           Returns False if nested set invariants don't hold afterwards, then the tree must be rebuilt."""
+        tree_id = first_tree_id - 1
+        root_lft = root_level = None
+        for node in sorted(nodes, key=lambda node: node.lft):
+            if parents.get(node.pk) is None:
+                tree_id += 1
+                root_lft = node.lft
+                root_level = node.level
+            elif root_lft is None:
+                return False
+            node.tree_id = tree_id
+            node.lft = node.lft - root_lft + 1
+            node.rght = node.rght - root_lft + 1
+            node.level = node.level - root_level
+        by_id = dict((node.pk, node) for node in nodes)
+        tree_values = {}
+        for node in nodes:
+            if node.lft >= node.rght:
+                return False
+            tree_values.setdefault(node.tree_id, []).extend((node.lft, node.rght))
+            parent_id = parents.get(node.pk)
+            if parent_id is None:
+                continue
+            parent = by_id.get(parent_id)
+            if parent is None or parent.tree_id != node.tree_id or parent.level != node.level - 1:
+                return False
+            if not parent.lft < node.lft < node.rght < parent.rght:
+                return False
+        # no gaps nor overlaps, a tree uses every value from 1 to twice its size once
+        for values in tree_values.itervalues():
+            if sorted(values) != range(1, len(values) + 1):
+                return False
+        return True
 
     def _shift_min_id(self, cat_id, min_id):
         """this method is necessary because both Joomla's Categories and Tags are Categories in Cyclope.
@@ -567,24 +3019,111 @@ class Command(BaseCommand):
             imagenes.append(image_hash)
         return imagenes
 
-    def _parse_html_images(self, content_hash, article_id, error_counter):
-        """instances images from content's embedded <img> HTML tags."""
-        imagenes = []
-        full_content = self._joomla_content(content_hash)
-        try: # FIXME x-treme hack! html.fromstring having ID collisions, collect_ids is not an option...
-            context = etree.iterparse(BytesIO(full_content.encode('utf-8')), huge_tree=True, html=True)
-            for action, elem in context: pass # just read it
-            tree = context.root
-            sel = CSSSelector('img')
-            imgs = sel(tree)
-            for img in imgs:
-                src = img.get('src')
-                alt = img.get('alt')
-                image_hash = {'src': src, 'alt': alt, 'article_id': article_id, 'image_type': 'related'}
-                imagenes.append(image_hash)
-        except:
-            error_counter += 1
-        return imagenes, error_counter
+    def _parse_html(self, content_hash, article_id, error_counter):
+        """instances images from content's embedded <img> HTML tags, and finds its links to Joomla pages."""
+        parsed = parse_html(self._joomla_content(content_hash))
+        if parsed is None:
+            return [], [], error_counter + 1
+        imgs, links = parsed
+        return self._html_images_to_hashes(imgs, article_id), links, error_counter
+
+    def _parse_html_batch(self, content_hashes, error_counter, pool=None):
+        """_parse_html for a batch of contents, returns a list of images and one of links per content in the same order.
+           when a pool is given HTML parsing is spread in chunks among its worker processes."""
+        batch_images = []
+        batch_links = []
+        if not pool:
+            for content_hash in content_hashes:
+                imagenes, links, error_counter = self._parse_html(content_hash, content_hash['id'], error_counter)
+                batch_images.append(imagenes)
+                batch_links.append(links)
+            return batch_images, batch_links, error_counter
+        contents = [self._joomla_content(content_hash) for content_hash in content_hashes]
+        chunksize = max(1, len(contents) / (self.workers * 4))
+        # imap keeps the order of contents
+        for content_hash, parsed in zip(content_hashes, pool.imap(parse_html, contents, chunksize)):
+            if parsed is None:
+                error_counter += 1
+                parsed = [], []
+            imgs, links = parsed
+            batch_images.append(self._html_images_to_hashes(imgs, content_hash['id']))
+            batch_links.append(links)
+        return batch_images, batch_links, error_counter
+
+    def _html_images_to_hashes(self, imgs, article_id):
+        return [{'src': src, 'alt': alt, 'article_id': article_id, 'image_type': 'related'} for src, alt in imgs]
+
+    def _normalize_src(self, src):
+        """the same image can be referenced as /images/a b.jpg, ./images/a%20b.jpg or images/a b.jpg?v=2,
+           local paths are normalized so they're all the same image. data URIs are discarded."""
+        if not src:
+            return None
+        src = urllib.unquote(src.strip().encode('utf-8')).decode('utf-8', 'replace')
+        if src.startswith('data:'):
+            return None
+        if re.match('^[a-zA-Z]+://', src):
+            return src
+        src = src.split('?')[0].split('#')[0]
+        src = re.sub('/+', '/', src)
+        src = re.sub('^(\./|/)+', '', src)
+        return src or None
+
+    def _load_link_index(self, mysql_cnx):
+        """Joomla ids to what their links become: articles to their slugs, read from Joomla at once
+           since links can point to articles not migrated yet, categories to their slugs and menu items to their urls,
+           already migrated with the same ids."""
+        cursor = mysql_cnx.select('content', ('id', 'alias'))
+        articles = dict((row['id'], self._joomla_slugify(row['id'], row['alias'])) for row in cursor)
+        cursor.close()
+        categories = dict(Category.objects.filter(collection=self._categories_collection).values_list('id', 'slug'))
+        menuitems = dict(MenuItem.objects.values_list('id', 'url'))
+        self._link_index = {'article': articles, 'category': categories, 'menuitem': menuitems}
+
+    def _joomla_link_url(self, href):
+        """Cyclope's url for a link to a Joomla article, category or menu item,
+           index.php?option=com_content&view=article&id=123:alias&Itemid=4#anchor. None if it's not known."""
+        parts = urlparse.urlsplit(href.strip())
+        if parts.netloc or (parts.path.strip('./') and not parts.path.endswith('index.php')):
+            return None
+        query = urlparse.parse_qs(parts.query)
+        try:
+            # ids can come with their alias, 123:alias
+            object_id = int(query.get('id', [''])[0].split(':')[0])
+        except ValueError:
+            object_id = None
+        view = query.get('view', [None])[0]
+        url = None
+        if query.get('option', [None])[0] == 'com_content' and view in ('article', 'category', 'blog') and object_id:
+            if view == 'article' and object_id in self._link_index['article']:
+                url = self._article_url.format(self._link_index['article'][object_id])
+            elif view != 'article' and object_id in self._link_index['category']:
+                url = self._category_url.format(self._link_index['category'][object_id])
+        elif 'Itemid' in query:
+            try:
+                menuitem_url = self._link_index['menuitem'].get(int(query['Itemid'][0]))
+            except ValueError:
+                menuitem_url = None
+            if menuitem_url:
+                url = self._menuitem_url.format(menuitem_url)
+        if url and parts.fragment:
+            url += '#' + parts.fragment
+        return url
+
+    def _rewrite_links(self, text, links):
+        """replaces the href of the given links in text with their Cyclope url, where it's known.
+           hrefs are matched unescaped, as the HTML parser found them. Returns the text and how many were rewritten."""
+        urls = dict((href, self._joomla_link_url(href)) for href in links)
+        urls = dict((href, url) for href, url in urls.items() if url)
+        if not urls:
+            return text, 0
+        rewritten = [0]
+        def rewrite(match):
+            url = urls.get(html_parser.unescape(match.group(3)))
+            if not url:
+                return match.group(0)
+            rewritten[0] += 1
+            return u'{}{}{}{}'.format(match.group(1), match.group(2), url, match.group(2))
+        return href_re.sub(rewrite, text), rewritten[0]
 
     def _joomla_slugify(self, pk, alias):
         """joomla's URLs consist of the primary-key followed by a hyphen and the alias"""
@@ -608,29 +3147,87 @@ class Command(BaseCommand):
             elif image_hash['image_type'] == 'related':
                 related_tuple = (article_type_id, article_id, picture_type_id, picture_id)
                 related_images.append(related_tuple)
-        if article_images:
-            article_images_chunks = self._split_large_inserts(article_images)
-            for article_images_chunk in article_images_chunks:
-                article_images_query = "INSERT INTO articles_article_pictures ('article_id', 'picture_id') VALUES {}".format(article_images_chunk)
-                article_images_query =  self._clean_list(article_images_query)
-                self._raw_sqlite_execute(article_images_query)
-        if related_images:
-            related_images_chunks = list(self._split_large_inserts(related_images))
-            for related_images_chunk in related_images_chunks:
-                related_content_query = "INSERT INTO cyclope_relatedcontent ('self_type_id', 'self_id', 'other_type_id', 'other_id') VALUES {}".format(related_images_chunk)
-                related_content_query = self._clean_list(related_content_query)
-                self._raw_sqlite_execute(related_content_query)
-
-    def _raw_sqlite_execute(self, query):
-        sqlite = connection.cursor()
+        article_pictures = Article.pictures.through._meta.db_table
+        self._bulk_insert(article_pictures, ('article_id', 'picture_id'), article_images)
+        self._rows_written['Article.pictures'] += len(article_images)
+        related_content = RelatedContent._meta.db_table
+        self._bulk_insert(related_content, ('self_type_id', 'self_id', 'other_type_id', 'other_id'), related_images)
+        self._rows_written['RelatedContent'] += len(related_images)
+
+    def _bulk_insert(self, table, columns, rows):
+        """Inserts rows in table the fastest way each database backend allows, within the phase transaction:
+           COPY in PostgreSQL, multi row INSERTs in MySQL, and parameterized executemany elsewhere (SQLite).
+           Rows are sent _bulk_insert_rows[vendor] at a time."""
+        if not rows:
+            return
+        vendor = connection.vendor
+        batch_size = self._bulk_insert_rows.get(vendor, self._bulk_insert_rows['default'])
+        quoted_table = connection.ops.quote_name(table)
+        quoted_columns = ', '.join(connection.ops.quote_name(column) for column in columns)
+        placeholders = '({})'.format(', '.join(['%s'] * len(columns)))
+        cursor = connection.cursor()
+        try:
+            for i in xrange(0, len(rows), batch_size):
+                chunk = rows[i:i+batch_size]
+                if vendor == 'postgresql':
+                    # the wrapper passes copy_from on to psycopg2's cursor
+                    cursor.copy_from(self._copy_file(chunk), quoted_table, columns=[connection.ops.quote_name(column) for column in columns])
+                elif vendor == 'mysql':
+                    query = "INSERT INTO {} ({}) VALUES {}".format(quoted_table, quoted_columns, ', '.join([placeholders] * len(chunk)))
+                    cursor.execute(query, [value for row in chunk for value in row])
+                else:
+                    query = "INSERT INTO {} ({}) VALUES {}".format(quoted_table, quoted_columns, placeholders)
+                    cursor.executemany(query, chunk)
+        finally:
+            cursor.close()
+        # django < 1.6 doesn't know raw SQL changed anything, it wouldn't commit it
+        if transaction.is_managed():
+            transaction.set_dirty()
+        else:
+            transaction.commit_unless_managed()
+        self._count_queries()
+
+    def _bulk_update_parents(self, model, parents):
+        """Sets the parent of model's rows, parents maps their ids to their parent ids. Rows are updated
+           _bulk_update_rows at a time with UPDATE ... SET parent = CASE id WHEN ... END, instead of once per parent."""
+        items = parents.items()
+        if not items:
+            return
+        quoted_table = connection.ops.quote_name(model._meta.db_table)
+        quoted_pk = connection.ops.quote_name(model._meta.pk.column)
+        quoted_parent = connection.ops.quote_name(model._meta.get_field('parent').column)
+        cursor = connection.cursor()
         try:
-            sqlite.execute(query)
-            connection.commit()
+            for i in xrange(0, len(items), self._bulk_update_rows):
+                chunk = items[i:i+self._bulk_update_rows]
+                query = "UPDATE {0} SET {1} = CASE {2} {3} END WHERE {2} IN ({4})".format(
+                    quoted_table, quoted_parent, quoted_pk, ' '.join(['WHEN %s THEN %s'] * len(chunk)), ', '.join(['%s'] * len(chunk)))
+                cursor.execute(query, [value for item in chunk for value in item] + [pk for pk, parent_id in chunk])
         finally:
-            sqlite.close()
+            cursor.close()
+        if transaction.is_managed():
+            transaction.set_dirty()
+        else:
+            transaction.commit_unless_managed()
+        self._rows_written[model.__name__] += len(items)
+        self._count_queries()
+
+    def _copy_file(self, rows):
+        """rows in PostgreSQL COPY text format"""
+        lines = []
+        for row in rows:
+            values = []
+            for value in row:
+                if value is None:
+                    values.append('\\N')
+                else:
+                    value = unicode(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+                    values.append(value)
+            lines.append('\t'.join(values))
+        return StringIO(u'\n'.join(lines).encode('utf-8') + '\n')
 
     def _split_large_inserts(self, dataset):
-        """split INSERT VALUES into chunks of 500, that is SQLite's SQLITE_MAX_COMPOUND_SELECT limit in v.3.7
+        """split a dataset into chunks of 500, so IN lookups stay below SQLite's limit of 999 variables
            returns a generator, which must be instanced for ex. by the list() function"""
         n = 500
         for i in xrange(0, len(dataset), n):
@@ -665,10 +3262,11 @@ class Command(BaseCommand):
         src = image_hash['src']
         alt = image_hash['alt'] if image_hash['alt'] else ""
         name = src.split('/')[-1].split('.')[0] # get rid of path and extension
-        name = slugify(name)
-        # we don't really care about image's slugs, and article_id can be useful
-        slug = self._joomla_slugify(image_hash['article_id'], name)
+        name = cached_slugify(name)
+        # pictures are shared among articles, repeated names get a counter in _save_pictures_batch
+        slug = name
         picture = Picture(
+            # with --joomla-root it's pointed to its ingested file, if found, by _ingest_pictures
             image = src,
             description = alt,
             name = name,
@@ -684,7 +3282,7 @@ class Command(BaseCommand):
             collection_id = self._categories_collection, # Contenidos
             name = category_hash['title'],
             active = category_hash['published']==1,
-            parent_id = category_hash['parent_id'] if category_hash['parent_id'] != 0 else None,
+            parent_id = self._tree_hierarchy(category_hash['parent_id']),
             # Cyclope and Joomla use the same tree algorithm
             lft = category_hash['lft'],
             rght = category_hash['rgt'],
@@ -694,6 +3292,9 @@ class Command(BaseCommand):
         return category
 
     def _tag_to_category(self, tag_hash, min_id):
+        """None for Joomla's ROOT tag, like the root of categories it isn't migrated and its children are top level."""
+        if tag_hash['id'] == 1:
+            return None
         category_id = self._shift_min_id(tag_hash['id'], min_id)
         parent_id = self._tree_hierarchy(tag_hash['parent_id'])
         if parent_id:
@@ -739,8 +3340,7 @@ class Command(BaseCommand):
             last_login = user_hash['lastvisitDate'] if user_hash['lastvisitDate'] else datetime.now(),
             date_joined = user_hash['registerDate'],
         )
-        password = self.joomla_password if self.joomla_password else user.username
-        user.set_password(password)
+        # password is set by _hash_passwords
         return user
 
     def _module_to_html_block(self, block_hash):
@@ -783,11 +3383,6 @@ class Command(BaseCommand):
         )
         return menuitem
 
-    def _menu_to_menuitem_tree(self, menu_hash):
-        menuitem = MenuItem.objects.get(pk=menu_hash['id'])
-        menuitem.parent_id = self._tree_hierarchy(menu_hash['parent_id'])
-        return menuitem
-
     def _tree_hierarchy(self, parent_id):
         """0 is default value, and 1 is Menu Item Root, a Menu with no menutype
            the same logic is valid for Tags tree Root ids"""
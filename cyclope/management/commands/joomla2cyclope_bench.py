@@ -0,0 +1,436 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management import call_command
+from optparse import make_option
+from cyclope.management.commands.joomla2cyclope import Command as MigrationCommand
+import pymysql
+import random
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+class Command(BaseCommand):
+    help = """
+    Generates a synthetic Joomla site and benchmarks the joomla2cyclope migration phases on it.
+
+    Usage: (cyclope_workenv)$ python manage.py joomla2cyclope_bench --scale 10 --load --server localhost --database JOOMLA_BENCH --user root --password PASSWORD
+
+    The site is written as a mysqldump-like file with --dump-out, and/or loaded into a MySQL compatible server with --load.
+    Then every phase of joomla2cyclope is run against it, and the rows per second, CPU and memory of each one are reported.
+    Without --load the migration reads the dump file instead of MySQL.
+    With --phase only that phase is measured, the phases it depends on are migrated first by a run of their own:
+    (cyclope_workenv)$ python manage.py joomla2cyclope_bench --scale 10 --dump-out bench.sql.gz --phase content
+
+    WARNING: the migration is run against Cyclope's configured database, use a scratch one.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--scale',
+            action='store',
+            dest='scale',
+            default=1,
+            help='Scale factor, 1 is 1000 articles, 50 users, 20 categories and so on.'
+        ),
+        make_option('--seed',
+            action='store',
+            dest='seed',
+            default=0,
+            help='Random seed, the same seed and scale generate the same site.'
+        ),
+        make_option('--dump-out',
+            action='store',
+            dest='dump_out',
+            default=None,
+            help='Write the generated site as SQL to this file, gzipped if it ends in .gz'
+        ),
+        make_option('--load',
+            action='store_true',
+            dest='load',
+            default=False,
+            help='Load the generated site into the MySQL database, replacing its tables.'
+        ),
+        make_option('--generate-only',
+            action='store_true',
+            dest='generate_only',
+            default=False,
+            help='Don\'t run the migration.'
+        ),
+        make_option('--server',
+            action='store',
+            dest='server',
+            default='localhost',
+            help='Joomla host name'
+        ),
+        make_option('--database',
+            action='store',
+            dest='db',
+            default=None,
+            help='Database name'
+        ),
+        make_option('--user',
+            action='store',
+            dest='user',
+            default=None,
+            help='Database user'
+        ),
+        make_option('--password',
+            action='store',
+            dest='password',
+            default=None,
+            help='Database password'
+        ),
+        make_option('--prefix',
+            action='store',
+            dest='prefix',
+            default='jos_',
+            help='Joomla\'s tables prefix'
+        ),
+        make_option('--batch-size',
+            action='store',
+            dest='batch_size',
+            default=1000,
+            help='Passed on to joomla2cyclope.'
+        ),
+        make_option('--workers',
+            action='store',
+            dest='workers',
+            default=1,
+            help='Passed on to joomla2cyclope.'
+        ),
+        make_option('--phase',
+            action='store',
+            dest='phase',
+            default=None,
+            help='Benchmark only this phase of joomla2cyclope, e.g. content.'
+        ),
+        make_option('--report-out',
+            action='store',
+            dest='report_out',
+            default=None,
+            help='Write the benchmark results to this JSON file.'
+        ),
+        make_option('--noinput',
+            action='store_false',
+            dest='interactive',
+            default=True,
+            help='Don\'t ask for confirmation before migrating into Cyclope\'s database.'
+        ),
+    )
+
+    # rows per unit of scale
+    _scale_rows = {
+        'users': 50,
+        'categories': 20,
+        'tags': 30,
+        'menu': 20,
+        'modules': 5,
+        'content': 1000,
+        # distinct image files, articles share them
+        'images': 300,
+    }
+    # table name without prefix and its columns with MySQL types, only those used by joomla2cyclope
+    _schema = (
+        ('users', (('id', 'int(11)'), ('name', 'varchar(255)'), ('username', 'varchar(150)'), ('email', 'varchar(100)'),
+                   ('registerDate', 'datetime'), ('lastvisitDate', 'datetime'))),
+        ('menu_types', (('id', 'int(11)'), ('menutype', 'varchar(24)'), ('title', 'varchar(48)'), ('description', 'varchar(255)'))),
+        ('menu', (('id', 'int(11)'), ('menutype', 'varchar(24)'), ('title', 'varchar(255)'), ('alias', 'varchar(255)'),
+                  ('path', 'varchar(1024)'), ('link', 'varchar(1024)'), ('published', 'tinyint(4)'), ('parent_id', 'int(11)'),
+                  ('level', 'int(11)'), ('lft', 'int(11)'), ('rgt', 'int(11)'), ('home', 'tinyint(3)'))),
+        ('categories', (('id', 'int(11)'), ('path', 'varchar(255)'), ('extension', 'varchar(50)'), ('title', 'varchar(255)'),
+                        ('alias', 'varchar(255)'), ('description', 'mediumtext'), ('published', 'tinyint(1)'), ('parent_id', 'int(11)'),
+                        ('lft', 'int(11)'), ('rgt', 'int(11)'), ('level', 'int(11)'), ('modified_time', 'datetime'))),
+        ('tags', (('id', 'int(11)'), ('parent_id', 'int(11)'), ('lft', 'int(11)'), ('rgt', 'int(11)'), ('level', 'int(11)'),
+                  ('title', 'varchar(255)'), ('published', 'tinyint(1)'), ('modified_time', 'datetime'))),
+        ('modules', (('id', 'int(11)'), ('title', 'varchar(100)'), ('note', 'varchar(255)'), ('content', 'text'),
+                     ('published', 'tinyint(1)'), ('publish_up', 'datetime'), ('module', 'varchar(50)'))),
+        ('content', (('id', 'int(11)'), ('title', 'varchar(255)'), ('alias', 'varchar(255)'), ('introtext', 'mediumtext'),
+                     ('fulltext', 'mediumtext'), ('state', 'tinyint(3)'), ('catid', 'int(11)'), ('created', 'datetime'),
+                     ('created_by', 'int(11)'), ('modified', 'datetime'), ('images', 'text'))),
+        ('contentitem_tag_map', (('type_alias', 'varchar(255)'), ('core_content_id', 'int(11)'), ('content_item_id', 'int(11)'),
+                                 ('tag_id', 'int(11)'), ('tag_date', 'timestamp'), ('type_id', 'mediumint(8)'))),
+    )
+    _words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+              'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'enim', 'ad', 'minim', 'veniam',
+              'quis', 'nostrud', 'exercitation', 'ullamco', 'laboris', 'nisi', 'aliquip', 'ex', 'ea', 'commodo')
+    _insert_rows = 500
+    _epoch = datetime(2010, 1, 1)
+
+    def handle(self, *args, **options):
+        scale = float(options['scale'])
+        prefix = options['prefix']
+        sizes = dict((table, max(1, int(rows * scale))) for table, rows in self._scale_rows.items())
+
+        if options['dump_out']:
+            self._write_dump(options['dump_out'], prefix, sizes, int(options['seed']))
+            print "-> sitio generado en {}".format(options['dump_out'])
+        if options['load']:
+            self._load_mysql(options, prefix, sizes, int(options['seed']))
+            print "-> sitio generado en la base {}".format(options['db'])
+        if options['generate_only']:
+            return
+        if not options['load'] and not options['dump_out']:
+            raise CommandError("--load or --dump-out is required to run the migration.")
+
+        if options['interactive']:
+            confirm = raw_input("The migration will overwrite Cyclope's database. Type 'yes' to continue: ")
+            if confirm != 'yes':
+                raise CommandError("Benchmark cancelled.")
+
+        report = self._benchmark(options)
+        report['scale'] = scale
+        report['sizes'] = sizes
+        self._print_report(report)
+        if options['report_out']:
+            with open(options['report_out'], 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+
+    # BENCHMARK
+
+    def _benchmark(self, options):
+        """runs joomla2cyclope with metrics on a scratch checkpoint, and adds throughput to each phase.
+           With --phase the phases it depends on are run first, without metrics, and the phase is resumed from them."""
+        scratch_dir = tempfile.mkdtemp(prefix='joomla2cyclope_bench')
+        metrics_path = os.path.join(scratch_dir, 'metrics.json')
+        migration_options = {
+            'server': options['server'],
+            'db': options['db'],
+            'user': options['user'],
+            'password': options['password'],
+            'prefix': options['prefix'],
+            'dump': None if options['load'] else options['dump_out'],
+            'batch_size': options['batch_size'],
+            'workers': options['workers'],
+            'checkpoint': os.path.join(scratch_dir, 'checkpoint'),
+        }
+        try:
+            if options['phase']:
+                dependencies = self._phase_dependencies(options['phase'])
+                if dependencies:
+                    print "-> migrando las fases previas: {}".format(', '.join(dependencies))
+                    call_command('joomla2cyclope', phases=','.join(dependencies), **migration_options)
+                call_command('joomla2cyclope', phases=options['phase'], resume=True, metrics_out=metrics_path, **migration_options)
+            else:
+                call_command('joomla2cyclope', metrics_out=metrics_path, **migration_options)
+            with open(metrics_path) as metrics_file:
+                report = json.load(metrics_file)
+        finally:
+            shutil.rmtree(scratch_dir)
+        peak_rss = 0
+        for phase in report['phases']:
+            wall_time = phase['wall_time'] or 1e-9
+            rows_written = sum(phase['rows_written'].values())
+            phase['rows_read_per_second'] = phase['rows_read'] / wall_time
+            phase['rows_written_per_second'] = rows_written / wall_time
+            # ru_maxrss never goes down, its growth is what the phase added to the peak
+            phase['peak_rss_growth_kb'] = max(0, phase['peak_rss_kb'] - peak_rss)
+            peak_rss = max(peak_rss, phase['peak_rss_kb'])
+        return report
+
+    def _phase_dependencies(self, phase):
+        """the phases phase needs finished, directly or not, in joomla2cyclope's order."""
+        dependencies = dict(MigrationCommand._phase_dependencies)
+        if phase not in dependencies:
+            raise CommandError("Unknown phase {}, they are {}.".format(phase, ', '.join(name for name, _ in MigrationCommand._phase_dependencies)))
+        needed = set()
+        names = list(dependencies[phase])
+        while names:
+            name = names.pop()
+            if name not in needed:
+                needed.add(name)
+                names.extend(dependencies[name])
+        return [name for name, _ in MigrationCommand._phase_dependencies if name in needed]
+
+    def _print_report(self, report):
+        row = "{:<12} {:>10} {:>10} {:>9} {:>12} {:>12} {:>9} {:>11}"
+        print row.format('phase', 'read', 'written', 'seconds', 'read/s', 'written/s', 'cpu', 'peak MB')
+        for phase in report['phases']:
+            print row.format(
+                phase['phase'],
+                phase['rows_read'],
+                sum(phase['rows_written'].values()),
+                "%.2f" % phase['wall_time'],
+                "%.0f" % phase['rows_read_per_second'],
+                "%.0f" % phase['rows_written_per_second'],
+                "%.2f" % (phase['cpu_time'] + phase['children_cpu_time']),
+                "%.1f" % (phase['peak_rss_kb'] / 1024.0),
+            )
+        print "total: %.2f s" % report['wall_time']
+
+    # SYNTHETIC SITE
+
+    def _write_dump(self, path, prefix, sizes, seed):
+        dump = gzip.open(path, 'wb') if path.endswith('.gz') else open(path, 'wb')
+        try:
+            dump.write("SET NAMES utf8mb4;\n")
+            for statement in self._sql_statements(prefix, sizes, seed):
+                dump.write(statement.encode('utf-8'))
+                dump.write(";\n")
+        finally:
+            dump.close()
+
+    def _load_mysql(self, options, prefix, sizes, seed):
+        password = options['password'] if options['password'] else ""
+        cnx = pymysql.connect(host=options['server'], user=options['user'], password=password, charset='utf8mb4')
+        try:
+            cursor = cnx.cursor()
+            cursor.execute("CREATE DATABASE IF NOT EXISTS `{}` DEFAULT CHARACTER SET utf8mb4".format(options['db']))
+            cursor.execute("USE `{}`".format(options['db']))
+            for statement in self._sql_statements(prefix, sizes, seed):
+                cursor.execute(statement)
+            cnx.commit()
+            cursor.close()
+        finally:
+            cnx.close()
+
+    def _sql_statements(self, prefix, sizes, seed):
+        """yields DROP, CREATE and extended INSERT statements for each table, like mysqldump does."""
+        rnd = random.Random(seed)
+        tables = {
+            'users': self._users(rnd, sizes),
+            'menu_types': self._menu_types(),
+            'menu': self._menu(rnd, sizes),
+            'categories': self._categories(rnd, sizes),
+            'tags': self._tags(rnd, sizes),
+            'modules': self._modules(rnd, sizes),
+            'content': self._content(rnd, sizes),
+            'contentitem_tag_map': self._tag_map(rnd, sizes),
+        }
+        for table, columns in self._schema:
+            name = prefix + table
+            yield "DROP TABLE IF EXISTS `{}`".format(name)
+            yield self._create_table(name, columns)
+            values = []
+            for row in tables[table]:
+                values.append(u"({})".format(u",".join(self._sql_value(value) for value in row)))
+                if len(values) == self._insert_rows:
+                    yield u"INSERT INTO `{}` VALUES {}".format(name, u",".join(values))
+                    values = []
+            if values:
+                yield u"INSERT INTO `{}` VALUES {}".format(name, u",".join(values))
+
+    def _create_table(self, name, columns):
+        definitions = ["  `{}` {} DEFAULT NULL".format(column, column_type) for column, column_type in columns]
+        if columns[0][0] == 'id':
+            definitions.append("  PRIMARY KEY (`id`)")
+        return "CREATE TABLE `{}` (\n{}\n) DEFAULT CHARSET=utf8mb4".format(name, ",\n".join(definitions))
+
+    def _sql_value(self, value):
+        if value is None:
+            return u'NULL'
+        if isinstance(value, (int, long)):
+            return unicode(value)
+        if isinstance(value, datetime):
+            return u"'{}'".format(value.strftime('%Y-%m-%d %H:%M:%S'))
+        for char, escaped in ((u'\\', u'\\\\'), (u"'", u"\\'"), (u'\n', u'\\n'), (u'\r', u'\\r'), (u'\x00', u'\\0')):
+            value = value.replace(char, escaped)
+        return u"'{}'".format(value)
+
+    def _users(self, rnd, sizes):
+        for user_id in xrange(1, sizes['users'] + 1):
+            register = self._date(rnd)
+            last_visit = register + timedelta(days=rnd.randint(0, 700)) if rnd.random() < 0.8 else None
+            yield (user_id, u'Usuario {}'.format(user_id), u'usuario{}'.format(user_id), u'usuario{}@example.com'.format(user_id), register, last_visit)
+
+    def _menu_types(self):
+        for menu_id, menutype in enumerate(('mainmenu', 'footer', 'sections'), 1):
+            yield (menu_id, menutype, menutype.title(), u'')
+
+    def _menu(self, rnd, sizes):
+        """menu items link to categories, except for the root. each top level item starts a menu."""
+        yield (1, u'', u'Menu_Item_Root', u'root', u'', u'', 1, 0, 0, 0, sizes['menu'] * 2 + 1, 0)
+        menutypes = {}
+        # parents come before their children
+        for item_id, parent_id, lft, rgt, level in self._nested_set(rnd, sizes['menu']):
+            menutype = rnd.choice(('mainmenu', 'footer', 'sections')) if parent_id == 1 else menutypes[parent_id]
+            menutypes[item_id] = menutype
+            alias = u'item-{}'.format(item_id)
+            link = u'index.php?option=com_content&view=category&layout=blog&id={}'.format(rnd.randint(2, sizes['categories'] + 1))
+            yield (item_id, menutype, u'Item {}'.format(item_id), alias, alias, link, 1, parent_id, level, lft, rgt, int(item_id == 2))
+
+    def _categories(self, rnd, sizes):
+        yield (1, u'', u'system', u'ROOT', u'root', u'', 1, 0, 0, sizes['categories'] * 2 + 1, 0, self._epoch)
+        for category_id, parent_id, lft, rgt, level in self._nested_set(rnd, sizes['categories']):
+            # some repeated titles, the migration renames them "Categoria 1 (2)"
+            title = u'Categoria {}'.format(category_id % max(2, sizes['categories'] - 3))
+            yield (category_id, u'categoria-{}'.format(category_id), u'com_content', title, u'categoria-{}'.format(category_id),
+                   self._text(rnd, 5, 20), 1, parent_id, lft, rgt, level, self._date(rnd))
+
+    def _tags(self, rnd, sizes):
+        yield (1, 0, 0, sizes['tags'] * 2 + 1, 0, u'ROOT', 1, self._epoch)
+        for tag_id, parent_id, lft, rgt, level in self._nested_set(rnd, sizes['tags']):
+            yield (tag_id, parent_id, lft, rgt, level, u'Tag {}'.format(tag_id), 1, self._date(rnd))
+
+    def _modules(self, rnd, sizes):
+        for module_id in xrange(1, sizes['modules'] + 1):
+            module = 'mod_custom' if module_id % 4 else 'mod_menu'
+            yield (module_id, u'Modulo {}'.format(module_id), u'', self._html(rnd, sizes), 1, self._date(rnd), module)
+
+    def _content(self, rnd, sizes):
+        for article_id in xrange(1, sizes['content'] + 1):
+            created = self._date(rnd)
+            images = {"image_intro": "", "float_intro": "", "image_intro_alt": "", "image_intro_caption": "",
+                      "image_fulltext": "", "float_fulltext": "", "image_fulltext_alt": "", "image_fulltext_caption": ""}
+            if rnd.random() < 0.4:
+                images['image_intro'] = self._image_src(rnd, sizes)
+                images['image_intro_alt'] = self._text(rnd, 1, 4)
+            fulltext = self._html(rnd, sizes) if rnd.random() < 0.3 else u''
+            yield (article_id, self._text(rnd, 3, 8).capitalize(), u'articulo-{}'.format(article_id), self._html(rnd, sizes),
+                   fulltext, rnd.choice((1, 1, 1, 0, -1)), rnd.randint(2, sizes['categories'] + 1), created,
+                   rnd.randint(1, sizes['users']), created + timedelta(days=rnd.randint(0, 90)), json.dumps(images))
+
+    def _tag_map(self, rnd, sizes):
+        for article_id in xrange(1, sizes['content'] + 1):
+            tags = rnd.sample(xrange(2, sizes['tags'] + 2), min(sizes['tags'], rnd.randint(0, 3)))
+            for tag_id in tags:
+                yield (u'com_content.article', article_id, article_id, tag_id, self._date(rnd), 1)
+
+    def _nested_set(self, rnd, count, max_level=3):
+        """yields (id, parent_id, lft, rgt, level) for a random tree of count nodes under root id 1,
+           numbered like Joomla, where the root has lft 0."""
+        children = {1: []}
+        levels = {1: 0}
+        open_nodes = [1]
+        for node_id in xrange(2, count + 2):
+            parent_id = 1 if rnd.random() < 0.4 else rnd.choice(open_nodes)
+            children[parent_id].append(node_id)
+            children[node_id] = []
+            levels[node_id] = levels[parent_id] + 1
+            if levels[node_id] < max_level:
+                open_nodes.append(node_id)
+        nodes = []
+        counter = [0]
+        def visit(node_id, parent_id):
+            lft = counter[0]
+            counter[0] += 1
+            for child_id in children[node_id]:
+                visit(child_id, node_id)
+            rgt = counter[0]
+            counter[0] += 1
+            if node_id != 1:
+                nodes.append((node_id, parent_id, lft, rgt, levels[node_id]))
+        visit(1, 0)
+        return sorted(nodes)
+
+    def _html(self, rnd, sizes):
+        """paragraphs with a few images, sometimes with an internal Joomla link."""
+        paragraphs = [u'<p>{}</p>'.format(self._text(rnd, 20, 120)) for i in xrange(rnd.randint(1, 6))]
+        for i in xrange(rnd.choice((0, 0, 1, 1, 2, 3))):
+            img = u'<p><img src="{}" alt="{}" width="300" /></p>'.format(self._image_src(rnd, sizes), self._text(rnd, 1, 4))
+            paragraphs.insert(rnd.randint(0, len(paragraphs)), img)
+        if rnd.random() < 0.2:
+            link = u'<p><a href="index.php?option=com_content&amp;view=article&amp;id={0}">{1}</a></p>'
+            paragraphs.append(link.format(rnd.randint(1, sizes['content']), self._text(rnd, 2, 5)))
+        return u'\n'.join(paragraphs)
+
+    def _image_src(self, rnd, sizes):
+        image_id = rnd.randint(1, sizes['images'])
+        # the same file referenced in different ways
+        src = rnd.choice((u'images/stories/{}/foto-{}.jpg', u'/images/stories/{}/foto-{}.jpg', u'./images/stories/{}/foto-{}.jpg'))
+        return src.format(image_id % 10, image_id)
+
+    def _text(self, rnd, min_words, max_words):
+        return u' '.join(rnd.choice(self._words) for i in xrange(rnd.randint(min_words, max_words)))
+
+    def _date(self, rnd):
+        return self._epoch + timedelta(seconds=rnd.randint(0, 6 * 365 * 24 * 3600))
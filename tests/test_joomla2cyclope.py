@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""Tests of joomla2cyclope's parsing and bookkeeping helpers, they don't touch any database.
+   Run them from a Cyclope project, so the command and its models can be imported:
+   (cyclope_workenv)$ DJANGO_SETTINGS_MODULE=cyclope_project.settings python -m unittest discover -s tests"""
+
+from datetime import datetime, date
+from decimal import Decimal
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from django.core.management.base import CommandError
+
+from cyclope.management.commands.joomla2cyclope import (Command, DumpSource, StagingSource, UniqueValues,
+                                                        dump_rows, dump_value, where_match)
+
+
+class DumpParsingTest(unittest.TestCase):
+
+    def test_dump_rows(self):
+        values = u"(1,'a',NULL),(2,'it''s \\'quoted\\'\\n',0x6869),(3,'(,)',-1.5);\n"
+        self.assertEqual(list(dump_rows(values)), [
+            [u'1', u'a', None],
+            [u'2', u"it's 'quoted'\n", u'hi'],
+            [u'3', u'(,)', u'-1.5'],
+        ])
+
+    def test_dump_rows_keeps_like_escapes(self):
+        self.assertEqual(list(dump_rows(u"('50\\% \\_off');")), [[u'50\\% \\_off']])
+
+    def test_dump_value(self):
+        self.assertEqual(dump_value(u'12', 'int'), 12)
+        self.assertEqual(dump_value(u'1.5', 'double'), 1.5)
+        self.assertEqual(dump_value(u'1.50', 'decimal'), Decimal('1.50'))
+        self.assertEqual(dump_value(u'2014-03-02 10:20:30', 'datetime'), datetime(2014, 3, 2, 10, 20, 30))
+        self.assertEqual(dump_value(u'2014-03-02', 'date'), date(2014, 3, 2))
+        self.assertEqual(dump_value(u'0000-00-00 00:00:00', 'datetime'), None)
+        self.assertEqual(dump_value(None, 'int'), None)
+        self.assertEqual(dump_value(u'text', 'varchar'), u'text')
+
+    def test_where_match(self):
+        row = {'id': 5, 'state': 1, 'catid': None}
+        self.assertTrue(where_match(row, [('id', '>', 3), ('state', '=', 1)]))
+        self.assertFalse(where_match(row, [('id', '>', 3), ('state', '=', 0)]))
+        self.assertTrue(where_match(row, [(None, 'OR', [('id', '<', 3), ('state', 'IN', set([1, 2]))])]))
+        self.assertFalse(where_match(row, [(None, 'OR', [('id', '<', 3), ('state', '>=', 2)])]))
+        # NULLs don't match, like in SQL
+        self.assertFalse(where_match(row, [('catid', '<', 10)]))
+
+
+class DumpSourceTest(unittest.TestCase):
+
+    dump = (
+        "CREATE TABLE `jos_users` (\n"
+        "  `id` int(11) NOT NULL,\n"
+        "  `name` varchar(255) NOT NULL\n"
+        ") ENGINE=InnoDB;\n"
+        "INSERT INTO `jos_users` VALUES (1,'ana'),(2,'juan');\n"
+        "CREATE TABLE `jos_content` (\n"
+        "  `id` int(11) NOT NULL,\n"
+        "  `created` datetime NOT NULL\n"
+        ") ENGINE=InnoDB;\n"
+        "INSERT INTO `jos_content` VALUES (1,'2014-01-01 00:00:00'),(2,'0000-00-00 00:00:00');\n"
+        "INSERT INTO `jos_content` VALUES (3,'2014-01-03 00:00:00');\n"
+        "CREATE TABLE `jos_tags` (\n"
+        "  `id` int(11) NOT NULL\n"
+        ") ENGINE=InnoDB;\n"
+        "INSERT INTO `jos_tags` VALUES (1),(2);\n"
+    )
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'joomla.sql.gz')
+        dump_file = gzip.open(self.path, 'wb')
+        dump_file.write(self.dump)
+        dump_file.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_select(self):
+        source = DumpSource(self.path, 'jos_')
+        rows = source.select('content', ('id', 'created'), [('id', '>', 1)], order_by='id').fetchall()
+        self.assertEqual(rows, [{'id': 2, 'created': None}, {'id': 3, 'created': datetime(2014, 1, 3)}])
+        source.close()
+
+    def test_count_and_max(self):
+        source = DumpSource(self.path, 'jos_')
+        self.assertEqual(source.count('content'), 3)
+        self.assertEqual(source.max('content', 'id'), 3)
+        self.assertEqual(source.max('content', 'created'), datetime(2014, 1, 3))
+        source.close()
+
+    def test_split_insert_fails(self):
+        path = os.path.join(self.directory, 'split.sql')
+        with open(path, 'wb') as dump_file:
+            dump_file.write(self.dump.replace("(1,'ana'),", "(1,'ana'),\n"))
+        source = DumpSource(path, 'jos_')
+        self.assertRaises(CommandError, source.count, 'users')
+        # other tables can still be read
+        self.assertEqual(source.count('tags'), 2)
+
+    def test_ordered_by_columns(self):
+        path = os.path.join(self.directory, 'tag_map.sql')
+        with open(path, 'wb') as dump_file:
+            dump_file.write(
+                "CREATE TABLE `jos_contentitem_tag_map` (\n"
+                "  `type_id` mediumint(8) NOT NULL,\n"
+                "  `content_item_id` int(11) NOT NULL\n"
+                ") ENGINE=InnoDB;\n"
+                "INSERT INTO `jos_contentitem_tag_map` VALUES (1,2),(1,5),(2,1);\n")
+        source = DumpSource(path, 'jos_')
+        rows = source.select('contentitem_tag_map', ('content_item_id',), order_by=('type_id', 'content_item_id')).fetchall()
+        self.assertEqual([row['content_item_id'] for row in rows], [2, 5, 1])
+        self.assertRaises(CommandError, lambda: source.select('contentitem_tag_map', ('content_item_id',), order_by='content_item_id').fetchall())
+
+    def test_gzipped_tables_are_spilled(self):
+        source = DumpSource(self.path, 'jos_')
+        source._spill_bytes = 200
+        self.assertEqual([row['name'] for row in source.select('users', ('name',))], [u'ana', u'juan'])
+        # the first read went on to the end, content was too big to be kept
+        self.assertEqual(sorted(source._spills), ['jos_tags', 'jos_users'])
+        self.assertEqual([row['id'] for row in source.select('tags', ('id',))], [1, 2])
+        self.assertEqual([row['id'] for row in source.select('content', ('id',))], [1, 2, 3])
+        spill_dir = source._spill_dir
+        source.close()
+        self.assertFalse(os.path.exists(spill_dir))
+
+    def test_abandoned_read_isnt_spilled(self):
+        source = DumpSource(self.path, 'jos_')
+        cursor = source.select('content', ('id',))
+        cursor.fetchone()
+        cursor.close()
+        self.assertEqual(sorted(source._spills), ['jos_users'])
+        self.assertEqual([row['id'] for row in source.select('content', ('id',))], [1, 2, 3])
+        source.close()
+
+
+class StagingSourceTest(unittest.TestCase):
+
+    def test_chunk_matches(self):
+        source = StagingSource.__new__(StagingSource)
+        # offset, length, rows, first and last id
+        chunk = (0, 100, 10, 11, 20)
+        self.assertTrue(source._chunk_matches(chunk, 'id', [('id', '>', 15)]))
+        self.assertFalse(source._chunk_matches(chunk, 'id', [('id', '>', 20)]))
+        self.assertFalse(source._chunk_matches(chunk, 'id', [('id', '>=', 21)]))
+        self.assertFalse(source._chunk_matches(chunk, 'id', [('id', '<', 11)]))
+        self.assertTrue(source._chunk_matches(chunk, 'id', [('id', '=', 11)]))
+        self.assertFalse(source._chunk_matches(chunk, 'id', [('id', '=', 21)]))
+        # conditions on other columns can't skip it
+        self.assertTrue(source._chunk_matches(chunk, 'id', [('state', '=', 1)]))
+
+
+class UniqueValuesTest(unittest.TestCase):
+
+    def test_unique(self):
+        values = UniqueValues(['a', 'a-2'])
+        self.assertEqual([values.unique(value) for value in ('a', 'a', 'b', 'b')], ['a-3', 'a-4', 'b', 'b-2'])
+
+    def test_normalize(self):
+        names = UniqueValues([u'Noticias'], u'{} ({})', lambda name: name.lower())
+        self.assertEqual(names.unique(u'NOTICIAS'), u'NOTICIAS (2)')
+        self.assertEqual(names.unique(u'noticias'), u'noticias (3)')
+
+
+class Node(object):
+
+    def __init__(self, pk, lft, rght, level):
+        self.pk = pk
+        self.lft = lft
+        self.rght = rght
+        self.level = level
+
+
+class CommandHelpersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.command = Command()
+
+    def test_nested_set_tree(self):
+        # Joomla's root (1, 10) isn't migrated, 2 and 5 are top level
+        nodes = [Node(2, 2, 5, 1), Node(3, 3, 4, 2), Node(5, 6, 9, 1), Node(6, 7, 8, 2)]
+        parents = {2: None, 3: 2, 5: None, 6: 5}
+        self.assertTrue(self.command._nested_set_tree(nodes, parents, 3))
+        self.assertEqual([(node.tree_id, node.lft, node.rght, node.level) for node in nodes],
+                         [(3, 1, 4, 0), (3, 2, 3, 1), (4, 1, 4, 0), (4, 2, 3, 1)])
+
+    def test_tags_nested_set_tree(self):
+        # Joomla's ROOT tag (0, 7) is skipped, 2 and 4 are top level
+        rows = [(1, 0, 0, 7, 0), (2, 1, 1, 4, 1), (3, 2, 2, 3, 2), (4, 1, 5, 6, 1)]
+        tags = [{'id': tag_id, 'parent_id': parent_id, 'lft': lft, 'rgt': rgt, 'level': level, 'title': u'Tag', 'published': 1}
+                for tag_id, parent_id, lft, rgt, level in rows]
+        categories = [category for category in (self.command._tag_to_category(tag, 10) for tag in tags) if category]
+        self.assertEqual([category.pk for category in categories], [12, 13, 14])
+        parents = dict((category.pk, category.parent_id) for category in categories)
+        self.assertEqual(parents, {12: None, 13: 12, 14: None})
+        self.assertTrue(self.command._nested_set_tree(categories, parents, 1))
+        self.assertEqual([(category.tree_id, category.lft, category.rght, category.level) for category in categories],
+                         [(1, 1, 4, 0), (1, 2, 3, 1), (2, 1, 2, 0)])
+
+    def test_nested_set_tree_invalid(self):
+        # the child is outside its parent
+        nodes = [Node(2, 2, 3, 1), Node(3, 4, 5, 2)]
+        self.assertFalse(self.command._nested_set_tree(nodes, {2: None, 3: 2}, 1))
+
+    def test_joomla_link_url(self):
+        self.command._link_index = {'article': {123: u'hola'}, 'category': {7: u'noticias'}, 'menuitem': {4: u'inicio'}}
+        link_url = self.command._joomla_link_url
+        self.assertEqual(link_url('index.php?option=com_content&view=article&id=123:hola#arriba'), u'/article/hola/#arriba')
+        self.assertEqual(link_url('/index.php?option=com_content&view=category&id=7'), u'/category/noticias/')
+        self.assertEqual(link_url('index.php?Itemid=4'), u'/inicio/')
+        self.assertEqual(link_url('index.php?option=com_content&view=article&id=999'), None)
+        self.assertEqual(link_url('http://example.com/index.php?option=com_content&view=article&id=123'), None)
+        self.assertEqual(link_url('images/a.jpg'), None)
+
+    def test_normalize_src(self):
+        normalize = self.command._normalize_src
+        self.assertEqual(normalize(u'/images/a b.jpg'), u'images/a b.jpg')
+        self.assertEqual(normalize(u'./images/a%20b.jpg'), u'images/a b.jpg')
+        self.assertEqual(normalize(u'images//a b.jpg?v=2'), u'images/a b.jpg')
+        self.assertEqual(normalize(u'http://example.com/a.jpg'), u'http://example.com/a.jpg')
+        self.assertEqual(normalize(u'data:image/png;base64,AAAA'), None)
+        self.assertEqual(normalize(u''), None)
+
+
+class JoomlaSource(object):
+
+    def close(self):
+        pass
+
+
+class RunPhasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.command = Command()
+        self.command.checkpoint_dir = tempfile.mkdtemp()
+        self.command.metrics = None
+        self.command.parallel_phases = 2
+        self.command._checkpoint_lock = threading.RLock()
+        self.command._checkpoint = {'phases': {}, 'content': {'last_id': 0, 'count': 0}}
+
+    def tearDown(self):
+        shutil.rmtree(self.command.checkpoint_dir)
+
+    def test_failed_phase_keeps_content_state(self):
+        tags_started = threading.Event()
+        content_saved = threading.Event()
+
+        def content():
+            # batches committed while tags runs
+            tags_started.wait(10)
+            with self.command._checkpoint_lock:
+                self.command._checkpoint['content'].update(last_id=10, count=10)
+                self.command._save_checkpoint()
+            content_saved.set()
+            return 10, 100
+
+        def tags():
+            tags_started.set()
+            content_saved.wait(10)
+            raise ValueError("tags failed")
+
+        tasks = {
+            'content': lambda cnx, results: self.command._run_phase('content', content, atomic=False),
+            'tags': lambda cnx, results: self.command._run_phase('tags', tags),
+        }
+        phases = (('content', ()), ('tags', ()))
+        self.assertRaises(ValueError, self.command._run_phases, tasks, JoomlaSource(), JoomlaSource, phases)
+        with open(os.path.join(self.command.checkpoint_dir, 'state.json')) as state_file:
+            state = json.load(state_file)
+        self.assertEqual(state['content'], {'last_id': 10, 'count': 10})
+        self.assertEqual(state['phases'], {'content': [10, 100]})
+
+
+if __name__ == '__main__':
+    unittest.main()